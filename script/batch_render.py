@@ -0,0 +1,128 @@
+import pygame
+import numpy as np
+
+from itertools import repeat
+from typing import Tuple
+
+try:
+    from .shape_cache import SHAPES
+except ImportError:
+    from shape_cache import SHAPES
+
+
+Color = Tuple[int, int, int]
+
+
+def map_color(surface: pygame.Surface, color: Color) -> int:
+    return surface.map_rgb(color)
+
+
+def map_colors(surface: pygame.Surface, colors: np.ndarray) -> np.ndarray:
+    # Vectorized Surface.map_rgb for (n, 3) colours
+    colors = np.clip(np.rint(colors), 0, 255).astype(np.int64)
+    losses = surface.get_losses()
+    shifts = surface.get_shifts()
+    mapped = np.zeros(len(colors), dtype=np.int64)
+    for channel in range(3):
+        mapped |= (colors[:, channel] >> losses[channel]) << shifts[channel]
+    return mapped
+
+
+def clip_segments(starts: np.ndarray, ends: np.ndarray, clip: pygame.Rect) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Liang-Barsky against the clip rectangle. Returns the segments that touch it and the part of
+    # each one inside as fractions, so the caller can keep the pixels a full draw would have made
+    delta = ends - starts
+    enter = np.zeros(len(starts))
+    leave = np.ones(len(starts))
+    keep = np.ones(len(starts), dtype=bool)
+
+    # Against the pixel edges rather than the pixel centres, anything that rounds inside counts
+    left, top = clip.left - 0.5, clip.top - 0.5
+    right, bottom = clip.right - 0.5, clip.bottom - 0.5
+
+    for p, q in ((-delta[:, 0], starts[:, 0] - left), (delta[:, 0], right - starts[:, 0]),
+                 (-delta[:, 1], starts[:, 1] - top), (delta[:, 1], bottom - starts[:, 1])):
+        parallel = p == 0
+        keep &= ~(parallel & (q < 0))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = q / p
+        enter = np.where(~parallel & (p < 0), np.maximum(enter, ratio), enter)
+        leave = np.where(~parallel & (p > 0), np.minimum(leave, ratio), leave)
+
+    keep &= enter <= leave
+    return np.flatnonzero(keep), enter[keep], leave[keep]
+
+
+def draw_segments(surface: pygame.Surface, starts: np.ndarray, ends: np.ndarray, color: int):
+    # Rasterize many one pixel wide segments straight into the pixel array, `color` is a mapped
+    # surface colour. The surface clip is honoured, dirty rect redraws rely on it
+    clip = surface.get_clip()
+    if clip.width == 0 or clip.height == 0:
+        return
+
+    starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+    finite = np.isfinite(starts).all(axis=1) & np.isfinite(ends).all(axis=1)
+    if not finite.all():
+        starts, ends = starts[finite], ends[finite]
+    if len(starts) == 0:
+        return
+
+    delta = ends - starts
+    steps = np.ceil(np.abs(delta).max(axis=1)).astype(np.intp) + 1
+    increments = delta / np.maximum(steps - 1, 1)[:, None]
+    first_offset = None
+
+    # Usually everything is on screen already, the clipping pass is only paid when it is not
+    lowest = np.minimum(starts, ends).min(axis=0)
+    highest = np.maximum(starts, ends).max(axis=0)
+    if not (lowest[0] >= clip.left and lowest[1] >= clip.top and
+            highest[0] <= clip.right - 1 and highest[1] <= clip.bottom - 1):
+        # Only the inside steps of each segment are walked, a partial redraw lights exactly the
+        # pixels of a full one and leaves no seam along the clip edge
+        indices, enter, leave = clip_segments(starts, ends, clip)
+        # One extra step at both ends covers floating point error at the edges
+        last_step = steps[indices] - 1
+        first_offset = np.maximum(np.ceil(enter * last_step).astype(np.intp) - 1, 0)
+        counts = np.minimum(np.floor(leave * last_step).astype(np.intp) + 1, last_step) - first_offset + 1
+
+        inside = counts > 0
+        indices, first_offset, steps = indices[inside], first_offset[inside], counts[inside]
+        starts, increments = starts[indices], increments[indices]
+        if len(starts) == 0:
+            return
+
+    first_pixel = np.cumsum(steps) - steps
+    offsets = np.arange(int(first_pixel[-1] + steps[-1])) - np.repeat(first_pixel, steps)
+    if first_offset is not None:
+        offsets += np.repeat(first_offset, steps)
+
+    # x and y as separate flat arrays, the (n, 2) temporaries cost more than the rest together
+    x = np.rint(np.repeat(starts[:, 0], steps) + np.repeat(increments[:, 0], steps) * offsets).astype(np.intp)
+    y = np.rint(np.repeat(starts[:, 1], steps) + np.repeat(increments[:, 1], steps) * offsets).astype(np.intp)
+
+    if first_offset is not None:
+        # Rounding can still land half a pixel past the edge
+        inside = (x >= clip.left) & (x < clip.right) & (y >= clip.top) & (y < clip.bottom)
+        x, y = x[inside], y[inside]
+
+    pixels = pygame.surfarray.pixels2d(surface)
+    pixels[x, y] = color
+    del pixels
+
+
+def draw_polylines(surface: pygame.Surface, polylines: np.ndarray, color: Color):
+    # (lines, points, 2), every polyline of the batch in one rasterizer call
+    polylines = np.asarray(polylines, dtype=float)
+    if polylines.shape[1] < 2:
+        return
+    draw_segments(surface, polylines[:, :-1].reshape(-1, 2), polylines[:, 1:].reshape(-1, 2), map_color(surface, color))
+
+
+def draw_circles(surface: pygame.Surface, centers: np.ndarray, color: Color, radius: int):
+    # Filled circles as one Surface.blits of a cached shape, placed like pygame.draw.circle would
+    if len(centers) == 0:
+        return
+    corners = (np.asarray(centers, dtype=float).reshape(-1, 2).astype(np.intp) - radius).tolist()
+    surface.blits(zip(repeat(SHAPES.circle(color, radius)), corners), doreturn=False)
@@ -0,0 +1,73 @@
+import time
+import numpy as np
+
+from spatial import SpatialHash, UniformGrid
+
+
+NODE_COUNTS = (1_000, 10_000, 100_000, 1_000_000)
+QUERY_RADIUS = 15
+QUERY_COUNT = 200
+STEP_COUNT = 5
+DENSITY_SPACING = 10
+HASH_NODE_LIMIT = 100_000
+
+
+def time_per_call(function, arguments) -> float:
+    start = time.perf_counter()
+    for argument in arguments:
+        function(argument)
+    return (time.perf_counter() - start) / len(arguments)
+
+
+def brute_force_query(positions: np.ndarray, center, radius: float) -> np.ndarray:
+    delta = positions - center
+    return np.flatnonzero(np.einsum("ij,ij->i", delta, delta) <= radius * radius)
+
+
+def main():
+    random = np.random.default_rng(0)
+
+    print("Radius query, node density kept constant as the scene grows")
+    print("Moving nodes need a rebuild every step, 'step' is a rebuild plus one grid query")
+    print("%10s %14s %14s %14s %14s %14s" % ("nodes", "brute (us)", "grid (us)", "hash (us)", "rebuild (ms)", "step (us)"))
+
+    for node_count in NODE_COUNTS:
+        # Grow the area with the node count, so every query sees about the same amount of nodes
+        side = np.sqrt(node_count) * DENSITY_SPACING
+        positions = random.uniform(0, side, size=(node_count, 2))
+        centers = random.uniform(0, side, size=(QUERY_COUNT, 2))
+
+        grid = UniformGrid(cell_size=QUERY_RADIUS)
+        start = time.perf_counter()
+        grid.rebuild(positions)
+        rebuild_time = time.perf_counter() - start
+
+        brute_time = time_per_call(lambda center: brute_force_query(positions, center, QUERY_RADIUS), centers)
+        grid_time = time_per_call(lambda center: grid.query_radius(center, QUERY_RADIUS), centers)
+
+        def grid_step(center):
+            grid.rebuild(positions)
+            grid.query_radius(center, QUERY_RADIUS)
+
+        step_time = time_per_call(grid_step, centers[:STEP_COUNT])
+
+        # The object keyed hash is filled one insert at a time, skip it for the biggest scenes
+        hash_label = "%14s" % "-"
+        if node_count <= HASH_NODE_LIMIT:
+            spatial_hash = SpatialHash(cell_size=QUERY_RADIUS)
+            for index, position in enumerate(positions.tolist()):
+                spatial_hash.insert(index, position)
+
+            hash_time = time_per_call(lambda center: spatial_hash.query_radius(center, QUERY_RADIUS), centers.tolist())
+            hash_label = "%14.1f" % (hash_time * 1e6)
+
+        for center in centers[:10]:
+            assert np.array_equal(np.sort(grid.query_radius(center, QUERY_RADIUS)),
+                                  brute_force_query(positions, center, QUERY_RADIUS))
+
+        print("%10d %14.1f %14.1f %s %14.2f %14.1f" % (
+            node_count, brute_time * 1e6, grid_time * 1e6, hash_label, rebuild_time * 1e3, step_time * 1e6))
+
+
+if __name__ == "__main__":
+    main()
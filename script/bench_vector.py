@@ -0,0 +1,132 @@
+import time
+import tracemalloc
+
+from typing import List
+from foundation import Math
+from vine import Vine
+
+
+VINE_COUNT = 50
+VINE_LENGTH = 20
+STEPS = 200
+DELTA_TIME = 1 / 30
+
+
+class TupleVine(Vine):
+    # Vine.update as it was before Vec2, every helper returning a new tuple. The debug gizmos
+    # it used to build are left out, they are behind a DebugDraw channel now
+    def __init__(self, *arguments, **kwargs):
+        super().__init__(*arguments, **kwargs)
+        for point in self.points:
+            point.position = point.position.as_tuple()
+            point.velocity = point.velocity.as_tuple()
+
+    def update(self, delta_time: float):
+        delta_time *= 2
+
+        for i, point in enumerate(self.points):
+            if i == 0:
+                continue
+
+            pull_from = self.points[i - 1].position
+            if i >= 2:
+                pull_direction = Math.normalize(Math.tuple_minus(self.points[i - 2].position, pull_from))
+            else:
+                pull_direction = (0, 1)
+
+            pull_to = (pull_direction[0] * point.magnitude + pull_from[0], pull_direction[1] * point.magnitude + pull_from[1])
+
+            lift_delta = Math.tuple_multiple(Math.tuple_minus(pull_from, point.position), 0.3)
+            acceleration = Math.tuple_plus(self.gravity, lift_delta)
+            acceleration = Math.tuple_plus(acceleration, Math.tuple_minus(pull_to, point.position))
+
+            point.velocity = Math.tuple_plus(point.velocity, Math.tuple_multiple(acceleration, delta_time))
+            suppose_point = Math.tuple_plus(point.position, Math.tuple_multiple(point.velocity, delta_time))
+            new_position = Math.tuple_plus(pull_from, Math.clamp_magnitude(Math.tuple_minus(suppose_point, pull_from), point.magnitude))
+
+            length_fix_delta = Math.tuple_minus(new_position, suppose_point)
+            point.velocity = Math.tuple_plus(point.velocity, Math.tuple_multiple(length_fix_delta, 1))
+
+            delta = Math.tuple_minus(new_position, point.position)
+            point.position = new_position
+
+            if self.parent_node_delta:
+                for e in range(i + 1, len(self.points)):
+                    self.points[e].position = Math.tuple_plus(self.points[e].position, delta)
+
+
+def make_vines(vine_class) -> List[Vine]:
+    return [vine_class((100 + index * 10, 10), node_delta=(3, 10), length=VINE_LENGTH, gravity=(0, 30))
+            for index in range(VINE_COUNT)]
+
+
+def step_vines(vines: List[Vine]):
+    for vine in vines:
+        vine.update(DELTA_TIME)
+
+
+def count_tuples(step) -> int:
+    # Every helper below returns a fresh tuple. Peak memory hides them, CPython recycles small
+    # tuples straight away, so count the calls of one step instead
+    calls = [0]
+    originals = {name: getattr(Math, name) for name in ("tuple_plus", "tuple_minus", "tuple_multiple", "clamp_magnitude", "normalize")}
+
+    def counted(function):
+        def wrapper(*arguments):
+            calls[0] += 1
+            return function(*arguments)
+        return staticmethod(wrapper)
+
+    for name, function in originals.items():
+        setattr(Math, name, counted(function))
+    try:
+        step()
+    finally:
+        for name, function in originals.items():
+            setattr(Math, name, staticmethod(function))
+
+    return calls[0]
+
+
+def measure(step) -> tuple:
+    step()
+
+    start = time.perf_counter()
+    for _ in range(STEPS):
+        step()
+    elapsed = (time.perf_counter() - start) / STEPS
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        step()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return elapsed, count_tuples(step), peak - before
+
+
+def main():
+    tuple_vines = make_vines(TupleVine)
+    vec2_vines = make_vines(Vine)
+
+    results = (
+        ("tuple Math", measure(lambda: step_vines(tuple_vines))),
+        ("Vec2 in place", measure(lambda: step_vines(vec2_vines))),
+    )
+
+    print("Vine.update on %d vines of %d nodes, per step" % (VINE_COUNT, VINE_LENGTH))
+    print("%-14s %10s %12s %12s" % ("", "time (ms)", "tuples", "peak (B)"))
+    for label, (elapsed, tuples, peak) in results:
+        print("%-14s %10.3f %12d %12d" % (label, elapsed * 1000, tuples, peak))
+
+    drift = max(abs(a - b) for tuple_vine, vec2_vine in zip(tuple_vines, vec2_vines)
+                for tuple_point, vec2_point in zip(tuple_vine.points, vec2_vine.points)
+                for a, b in zip(tuple_point.position, vec2_point.position))
+    print("largest difference between the two versions: %g" % drift)
+
+
+if __name__ == "__main__":
+    main()
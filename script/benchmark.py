@@ -0,0 +1,355 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pygame
+
+from typing import Callable, Dict, List, Tuple
+
+from foundation import ManagedWindow, Entity, SHAPES
+from cloth import Cloth, ClothEngine, CircleObstacle
+from vine import Vine, VineField
+from bezier_curve import Anchor, BezeirCurve, BezeirCurveDebug
+from renderer_3d import Camera, Cube
+
+
+# Every case builds a scene of a given size and hands back its update and draw calls
+Case = Callable[[int], Tuple[Callable[[], None], Callable[[ManagedWindow], None]]]
+
+WINDOW_SIZE = (800, 800)
+# The window only uses its pool with more than one worker, fewer runs cloth_parallel serially
+PARALLEL_WORKERS = os.cpu_count() or 1
+DELTA_TIME = 1 / 30
+
+
+def draw_entity(entity: Entity) -> Callable[[ManagedWindow], None]:
+    return lambda window: entity.draw(window)
+
+
+def cloth_case(size: int):
+    cloth = Cloth(size, size)
+    return lambda: cloth.update(DELTA_TIME), draw_entity(cloth)
+
+
+def cloth_verlet_case(size: int):
+    cloth = Cloth(size, size, solver=ClothEngine.VERLET)
+    return lambda: cloth.update(DELTA_TIME), draw_entity(cloth)
+
+
+def cloth_tear_case(size: int):
+    # An obstacle pushed up through the cloth keeps tearing it, p95 shows any spikes
+    cloth = Cloth(size, size, solver=ClothEngine.VERLET, tear_ratio=1.3)
+    obstacle = CircleObstacle((100 + size * 10, 100 + size * 30), radius=size * 2)
+    cloth.add_obstacle(obstacle)
+
+    def update():
+        obstacle.position = (obstacle.position[0], obstacle.position[1] - 2)
+        cloth.update(DELTA_TIME)
+
+    return update, draw_entity(cloth)
+
+
+def stepped_cloths(size: int, workers: int):
+    # Four separate verlet cloths stepped through the window, workers=0 keeps them on this thread
+    window = ManagedWindow(WINDOW_SIZE, headless=True, workers=workers)
+    window.children.extend(Cloth(size, size, solver=ClothEngine.VERLET) for _ in range(4))
+
+    def draw(target: ManagedWindow):
+        for cloth in window.children:
+            cloth.draw(target)
+
+    return window.step_children, draw
+
+
+def cloth_serial_case(size: int):
+    return stepped_cloths(size, 0)
+
+
+def cloth_parallel_case(size: int):
+    # One worker per core, compare against cloth_serial for the same size
+    return stepped_cloths(size, PARALLEL_WORKERS)
+
+
+def make_vines(count: int) -> List[Vine]:
+    return [Vine((100 + index % 600, 10), node_delta=(0, 10), length=20, gravity=(0, 30)) for index in range(count)]
+
+
+def vine_case(count: int):
+    vines = make_vines(count)
+
+    def update():
+        for vine in vines:
+            vine.update(DELTA_TIME)
+
+    def draw(window: ManagedWindow):
+        for vine in vines:
+            vine.draw(window)
+
+    return update, draw
+
+
+def vine_force_case(count: int):
+    vines = make_vines(count)
+
+    def update():
+        for vine in vines:
+            vine.apply_force((300, 100), 15, (1, 0))
+
+    return update, None
+
+
+def vine_field_case(count: int):
+    vine_field = VineField(node_count=20, gravity=(0, 30))
+    vine_field.add_vines([(100 + index % 600, 10) for index in range(count)], node_delta=(0, 10))
+
+    def update():
+        vine_field.update(DELTA_TIME)
+        vine_field.apply_force((300, 100), 15, (1, 0))
+
+    return update, draw_entity(vine_field)
+
+
+def moving_curves(count: int, tolerance: float=None):
+    curves = [BezeirCurve(Anchor((150, 150 + index % 500), (150, 200)), Anchor((650, 150), (650, 200 + index % 500)),
+                          tolerance=tolerance)
+              for index in range(count)]
+    frame = [0]
+
+    def update():
+        # The curves cache on their control points, a handle has to move for any work to happen
+        frame[0] += 1
+        offset = frame[0] % 2 * 10
+        for curve in curves:
+            handle = curve.anchor_1.handle_point
+            handle.position = (150 + offset, handle.position[1])
+            curve.recalculate_curve()
+
+    def draw(window: ManagedWindow):
+        for curve in curves:
+            curve.draw(window)
+
+    return update, draw
+
+
+def bezier_case(count: int):
+    return moving_curves(count)
+
+
+def bezier_adaptive_case(count: int):
+    return moving_curves(count, tolerance=0.25)
+
+
+def points_case(count: int):
+    # Anchor markers in every click state plus the construction circles of the debug curves
+    anchors = [Anchor((50 + index % 700, 50 + index // 7 % 700), (80 + index % 700, 50 + index // 7 % 700))
+               for index in range(count)]
+    for index, anchor in enumerate(anchors):
+        anchor.handle_point.status = index % 3
+    debugs = [BezeirCurveDebug(anchors[index], anchors[(index + 1) % count]) for index in range(count)]
+
+    def update():
+        for debug in debugs:
+            debug.update(DELTA_TIME)
+
+    def draw(window: ManagedWindow):
+        for anchor in anchors:
+            anchor.draw(window)
+        for debug in debugs:
+            debug.draw(window)
+
+    return update, draw
+
+
+def camera_case(count: int):
+    camera = Camera((0, 0, -10))
+    side = max(int(count ** 0.5), 1)
+    for index in range(count):
+        camera.render_objects.append(Cube(((index % side - side / 2) * 3, (index // side - side / 2) * 3, 40), 1))
+
+    # Camera.draw_object is now a one-object batch, the whole scene goes through one draw
+    return lambda: camera.update(DELTA_TIME), draw_entity(camera)
+
+
+CASES: Dict[str, Tuple[Case, Tuple[int, ...], Tuple[int, ...]]] = {
+    # name: (case, full sizes, quick sizes)
+    "cloth": (cloth_case, (5, 20, 50, 100, 200), (5, 50)),
+    "cloth_verlet": (cloth_verlet_case, (5, 20, 50, 100, 200), (5, 50)),
+    "cloth_tear": (cloth_tear_case, (20, 50, 100), (20,)),
+    "cloth_serial": (cloth_serial_case, (20, 50, 100), (50,)),
+    "cloth_parallel": (cloth_parallel_case, (20, 50, 100), (50,)),
+    "vine": (vine_case, (1, 10, 100, 1000, 10000), (1, 100)),
+    "vine_apply_force": (vine_force_case, (1, 10, 100, 1000, 10000), (1, 100)),
+    "vine_field": (vine_field_case, (1, 10, 100, 1000, 10000), (1, 1000)),
+    "bezier": (bezier_case, (1, 10, 100, 1000), (1, 100)),
+    "bezier_adaptive": (bezier_adaptive_case, (1, 10, 100, 1000), (1, 100)),
+    "points": (points_case, (1, 10, 100, 1000), (1, 100)),
+    "camera": (camera_case, (1, 10, 100, 1000), (1, 100)),
+}
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"mean_ms": None, "p95_ms": None}
+
+    samples_ms = np.array(samples) * 1000
+    return {"mean_ms": float(samples_ms.mean()), "p95_ms": float(np.percentile(samples_ms, 95))}
+
+
+def measure_allocations(function: Callable[[], None]) -> Dict[str, int]:
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        function()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"net_bytes": after - before, "peak_bytes": peak - before}
+
+
+def run_case(window: ManagedWindow, case: Case, size: int, repeats: int, max_seconds: float) -> Dict:
+    update, draw = case(size)
+
+    # Warm up once so lazy setup is not counted
+    update()
+    if draw is not None:
+        draw(window)
+
+    update_samples = []
+    draw_samples = []
+    start_time = time.perf_counter()
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        update()
+        update_samples.append(time.perf_counter() - start)
+
+        if draw is not None:
+            window.surface.fill(window.background_color)
+            start = time.perf_counter()
+            draw(window)
+            draw_samples.append(time.perf_counter() - start)
+
+        if len(update_samples) >= 3 and time.perf_counter() - start_time > max_seconds:
+            break
+
+    return {
+        "samples": len(update_samples),
+        "update": summarize(update_samples),
+        "draw": summarize(draw_samples),
+        "update_allocations": measure_allocations(update),
+    }
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+
+        for phase in ("update", "draw"):
+            mean, base_mean = result[phase]["mean_ms"], base[phase]["mean_ms"]
+            if mean is None or not base_mean:
+                continue
+
+            if mean > base_mean * (1 + threshold):
+                regressions.append("%s %s: %.3fms -> %.3fms (+%.0f%%)" % (
+                    key, phase, base_mean, mean, (mean / base_mean - 1) * 100))
+
+    return regressions
+
+
+def parallel_speedups(results: Dict) -> Dict[str, float]:
+    # Serial over parallel update time for every size both cases ran, above 1 means the pool helps
+    speedups = {}
+    for key, result in results.items():
+        name, size = key.split("/")
+        serial = results.get("cloth_serial/" + size)
+        if name != "cloth_parallel" or serial is None or not result["update"]["mean_ms"]:
+            continue
+        speedups[size] = serial["update"]["mean_ms"] / result["update"]["mean_ms"]
+    return speedups
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark of the playground scripts")
+    parser.add_argument("--cases", nargs="*", default=list(CASES), choices=list(CASES))
+    parser.add_argument("--quick", action="store_true", help="only run the small scene sizes")
+    parser.add_argument("--repeats", type=int, default=30)
+    parser.add_argument("--max-seconds", type=float, default=2, help="time budget per case and size")
+    parser.add_argument("--output", default="benchmark_result.json")
+    parser.add_argument("--baseline", help="earlier result file to flag regressions against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown ratio before flagging")
+    arguments = parser.parse_args()
+
+    window = ManagedWindow(WINDOW_SIZE, headless=True)
+    window.surface = pygame.Surface(WINDOW_SIZE)
+
+    cases = list(arguments.cases)
+    if "cloth_parallel" in cases and PARALLEL_WORKERS <= 1:
+        print("cloth_parallel skipped, %d worker would step the cloths serially" % PARALLEL_WORKERS)
+        cases.remove("cloth_parallel")
+
+    results = {}
+    for name in cases:
+        case, full_sizes, quick_sizes = CASES[name]
+
+        for size in quick_sizes if arguments.quick else full_sizes:
+            key = "%s/%d" % (name, size)
+            result = run_case(window, case, size, arguments.repeats, arguments.max_seconds)
+            results[key] = result
+
+            print("%-24s update mean %9.3fms p95 %9.3fms | draw mean %9s p95 %9s | alloc peak %8.1fKB" % (
+                key, result["update"]["mean_ms"], result["update"]["p95_ms"],
+                "-" if result["draw"]["mean_ms"] is None else "%.3fms" % result["draw"]["mean_ms"],
+                "-" if result["draw"]["p95_ms"] is None else "%.3fms" % result["draw"]["p95_ms"],
+                result["update_allocations"]["peak_bytes"] / 1024))
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "pygame": pygame.version.ver,
+            "platform": platform.platform(),
+            "quick": arguments.quick,
+            "shape_cache": SHAPES.stats(),
+            "cpu_count": os.cpu_count(),
+            "parallel_workers": PARALLEL_WORKERS,
+        },
+        "results": results,
+        "parallel_speedup": parallel_speedups(results),
+    }
+
+    for size, speedup in report["parallel_speedup"].items():
+        print("cloth_parallel/%s is %.2fx cloth_serial on %d workers" % (size, speedup, PARALLEL_WORKERS))
+
+    print("Shape cache %(size)d/%(capacity)d surfaces, %(hits)d hits, %(misses)d misses, "
+          "%(evictions)d evictions, hit rate %(hit_rate).1f%%" % dict(SHAPES.stats(), hit_rate=SHAPES.hit_rate * 100))
+
+    with open(arguments.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" % arguments.output)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)["results"]
+
+        regressions = compare(results, baseline, arguments.threshold)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s" % arguments.baseline)
+
+
+if __name__ == "__main__":
+    main()
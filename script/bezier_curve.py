@@ -1,11 +1,17 @@
 import pygame
+import numpy as np
+import math
+import sys
 
-from typing import Tuple
-from foundation import ManagedWindow, Point, Entity, InputSystem, Color, Math
+from typing import Dict, List, Optional, Set, Tuple
+from foundation import ManagedWindow, Point, Entity, InputSystem, Color, Math, Vector, Vec2, SHAPES
+from spatial import SpatialHash
 
 
 class ClickablePoint(Point):
-    def __init__(self, position, color=None, radius=3, width=2, hover_color=None, click_color=None, range=10):
+    def __init__(self, position, color=None, radius=3, width=2, hover_color=None, click_color=None, range=10,
+                 spatial_index: SpatialHash=None):
+        self.spatial_index = spatial_index
         super().__init__(position=position, color=color, radius=radius, width=width)
 
         if hover_color is None:
@@ -19,12 +25,34 @@ class ClickablePoint(Point):
             self.click_color = click_color
 
         self.status = 0
-        self.range = 10
+        self.range = range
+
+        # Mouse input and position the status was last worked out for, nothing to do until either changes
+        self.input_version = -1
+        self.checked_position = None
+
+    @property
+    def position(self) -> Vector:
+        return self._position
+
+    @position.setter
+    def position(self, value: Vector):
+        self._position = value
+
+        if self.spatial_index is not None:
+            self.spatial_index.move(self, value)
+
+    def hit(self, position: Vector) -> bool:
+        sqrt_magnitude = (position[0] - self.position[0]) ** 2 + (position[1] - self.position[1]) ** 2
+        return sqrt_magnitude <= (self.range * self.range)
 
     def update(self, delta_time: float):
-        sqrt_magnitude = (InputSystem.MOUSE_POS[0] - self.position[0]) ** 2 + (InputSystem.MOUSE_POS[1] - self.position[1]) ** 2
+        if self.input_version == InputSystem.mouse_version and self.checked_position == self.position:
+            return
+        self.input_version = InputSystem.mouse_version
+        self.checked_position = self.position
 
-        if sqrt_magnitude <= (self.range * self.range):
+        if self.hit(InputSystem.MOUSE_POS):
             if self.status != 2:
                 self.status = 1
 
@@ -39,25 +67,81 @@ class ClickablePoint(Point):
             elif self.status == 2 and InputSystem.MOUSE_UP:
                 self.status = 0
 
+    def draw_state(self):
+        return (*super().draw_state(), self.status)
+
+    def get_state(self) -> Optional[Dict[str, np.ndarray]]:
+        return {"position": np.array(self.position, dtype=float), "status": np.array(self.status)}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        self.position = tuple(state["position"].tolist())
+        self.status = int(state["status"])
+        self.input_version = -1
+
     def draw(self, window: "ManagedWindow"):
         if self.status == 0:
-            pygame.draw.circle(window.surface, self.color, self.position, self.radius, self.width)
+            self.blit_circle(window, self.color)
         elif self.status == 1:
-            pygame.draw.circle(window.surface, self.hover_color, self.position, self.radius, self.width)
+            self.blit_circle(window, self.hover_color)
         elif self.status == 2:
-            pygame.draw.circle(window.surface, self.click_color, self.position, self.radius, self.width)
+            self.blit_circle(window, self.click_color)
+        self.drawn_state = self.draw_state()
+
+
+class ClickablePointGroup(Entity):
+    # Hit-tests only the points near the mouse plus the ones already hovered or
+    # dragged, instead of every point every frame. Keep it in front of its owners
+    # in `window.children` so their points are up to date when the owners update
+    def __init__(self, cell_size=30):
+        self.spatial_index = SpatialHash(cell_size)
+        self.points: List[ClickablePoint] = []
+        self.engaged_points: Set[ClickablePoint] = set()
+        self.max_range = 0
+
+    def add(self, point: ClickablePoint):
+        point.spatial_index = self.spatial_index
+        self.spatial_index.insert(point, point.position)
+        self.points.append(point)
+        self.max_range = max(self.max_range, point.range)
+
+    def remove(self, point: ClickablePoint):
+        self.spatial_index.remove(point)
+        point.spatial_index = None
+        self.points.remove(point)
+        self.engaged_points.discard(point)
+
+    def update(self, delta_time: float):
+        nearby_points = self.spatial_index.query_radius(InputSystem.MOUSE_POS, self.max_range)
+
+        for point in self.engaged_points.union(nearby_points):
+            point.update(delta_time)
+
+            if point.status == 0:
+                self.engaged_points.discard(point)
+            else:
+                self.engaged_points.add(point)
+
+    def draw(self, window: "ManagedWindow"):
+        pass
 
 
 class Anchor(Entity):
-    def __init__(self, piviot_position, handle_poisition=None):
+    def __init__(self, piviot_position, handle_poisition=None, point_group: ClickablePointGroup=None):
         self.piviot_point: ClickablePoint = ClickablePoint(piviot_position, radius=8, width=0, range=30)
         self.handle_point: ClickablePoint = ClickablePoint(handle_poisition, radius=6, range=30, color=Color.GRAY)
         self.line_color = Color.GRAY
         self.has_change = False
+
+        # When grouped, the group does the hit-testing and the anchor only reacts to it
+        self.point_group = point_group
+        if point_group is not None:
+            point_group.add(self.piviot_point)
+            point_group.add(self.handle_point)
     
     def update(self,  delta_time: float):
         self.has_change = False
-        self.piviot_point.update(delta_time)
+        if self.point_group is None:
+            self.piviot_point.update(delta_time)
 
         if self.piviot_point.status == 2:
             delta = (self.handle_point.position[0] - self.piviot_point.position[0],
@@ -66,12 +150,19 @@ class Anchor(Entity):
             self.handle_point.position = (InputSystem.MOUSE_POS[0] + delta[0], InputSystem.MOUSE_POS[1] + delta[1])
             self.has_change = True
         
-        self.handle_point.update(delta_time)
+        if self.point_group is None:
+            self.handle_point.update(delta_time)
 
         if self.handle_point.status == 2:
             self.handle_point.position = InputSystem.MOUSE_POS
             self.has_change = True
 
+    def is_dirty(self) -> bool:
+        return self.piviot_point.is_dirty() or self.handle_point.is_dirty()
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        return self.piviot_point.bounding_rect().union(self.handle_point.bounding_rect())
+
     def draw(self, window: "ManagedWindow"):
         pygame.draw.line(window.surface, self.line_color, self.piviot_point.position, self.handle_point.position)
         self.piviot_point.draw(window)
@@ -88,6 +179,15 @@ class BezeirCurveDebug(Entity):
         self.percentage_speed = 0.3
 
         self.line_color = Color.GRAY
+        self.drawn_state = None
+
+        # The construction points, refilled every draw
+        self.center_1_1 = Vec2()
+        self.center_1_2 = Vec2()
+        self.center_1_3 = Vec2()
+        self.center_2_1 = Vec2()
+        self.center_2_2 = Vec2()
+        self.center_3_1 = Vec2()
     
     def update(self,  delta_time: float):
         if self.percentage_forward:
@@ -101,42 +201,64 @@ class BezeirCurveDebug(Entity):
                 self.percentage = 0
                 self.percentage_forward = True
 
+    def control_points(self) -> Tuple[Vector, Vector, Vector, Vector]:
+        return (self.anchor_1.piviot_point.position, self.anchor_1.handle_point.position,
+                self.anchor_2.handle_point.position, self.anchor_2.piviot_point.position)
+
+    def is_dirty(self) -> bool:
+        return (self.percentage, self.control_points()) != self.drawn_state
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        return Math.bounding_rect(self.control_points(), 11)
+
     def draw(self, window: "ManagedWindow"):
+        self.drawn_state = (self.percentage, self.control_points())
+
         pygame.draw.line(window.surface, self.line_color, self.anchor_1.handle_point.position, self.anchor_2.handle_point.position)
 
-        center_1_1 = Math.lerp_point(self.anchor_1.piviot_point.position, self.anchor_1.handle_point.position, self.percentage)
-        center_1_2 = Math.lerp_point(self.anchor_1.handle_point.position, self.anchor_2.handle_point.position, self.percentage)
-        center_1_3 = Math.lerp_point(self.anchor_2.handle_point.position, self.anchor_2.piviot_point.position, self.percentage)
+        center_1_1 = self.center_1_1.set_lerp(self.anchor_1.piviot_point.position, self.anchor_1.handle_point.position, self.percentage)
+        center_1_2 = self.center_1_2.set_lerp(self.anchor_1.handle_point.position, self.anchor_2.handle_point.position, self.percentage)
+        center_1_3 = self.center_1_3.set_lerp(self.anchor_2.handle_point.position, self.anchor_2.piviot_point.position, self.percentage)
 
-        pygame.draw.circle(window.surface, self.line_color, center_1_1, 3)
-        pygame.draw.circle(window.surface, self.line_color, center_1_2, 3)
-        pygame.draw.circle(window.surface, self.line_color, center_1_3, 3)
+        SHAPES.draw_circle(window.surface, self.line_color, center_1_1, 3)
+        SHAPES.draw_circle(window.surface, self.line_color, center_1_2, 3)
+        SHAPES.draw_circle(window.surface, self.line_color, center_1_3, 3)
 
         pygame.draw.line(window.surface, self.line_color, center_1_1, center_1_2)
         pygame.draw.line(window.surface, self.line_color, center_1_2, center_1_3)
 
-        center_2_1 = Math.lerp_point(center_1_1, center_1_2, self.percentage)
-        center_2_2 = Math.lerp_point(center_1_2, center_1_3, self.percentage)
+        center_2_1 = self.center_2_1.set_lerp(center_1_1, center_1_2, self.percentage)
+        center_2_2 = self.center_2_2.set_lerp(center_1_2, center_1_3, self.percentage)
 
-        pygame.draw.circle(window.surface, self.line_color, center_2_1, 3)
-        pygame.draw.circle(window.surface, self.line_color, center_2_2, 3)
+        SHAPES.draw_circle(window.surface, self.line_color, center_2_1, 3)
+        SHAPES.draw_circle(window.surface, self.line_color, center_2_2, 3)
 
         pygame.draw.line(window.surface, self.line_color, center_2_1, center_2_2)
 
-        center_3_1 = Math.lerp_point(center_2_1, center_2_2, self.percentage)
-        pygame.draw.circle(window.surface, Color.YELLOW, center_3_1, 10)
+        center_3_1 = self.center_3_1.set_lerp(center_2_1, center_2_2, self.percentage)
+        SHAPES.draw_circle(window.surface, Color.YELLOW, center_3_1, 10)
 
 
 class BezeirCurve(Entity):
-    def __init__(self, anchor_1, anchor_2):
+    MAX_SUBDIVISION_DEPTH = 16
+
+    def __init__(self, anchor_1, anchor_2, tolerance: float=None):
         self.anchor_1: Anchor = anchor_1
         self.anchor_2: Anchor = anchor_2
 
         self.lines = []
         self.iteration = 20
 
+        # Max distance in pixels between the curve and its polyline, None samples `iteration` even steps
+        self.tolerance = tolerance
+        self.cached_control_points = None
+
         self.recalculate_curve()
 
+    def control_points(self) -> Tuple[Vector, Vector, Vector, Vector]:
+        return (self.anchor_1.piviot_point.position, self.anchor_1.handle_point.position,
+                self.anchor_2.handle_point.position, self.anchor_2.piviot_point.position)
+
     def sample(self, percentage) -> Tuple[float, float]:
         center_1_1 = Math.lerp_point(self.anchor_1.piviot_point.position, self.anchor_1.handle_point.position, percentage)
         center_1_2 = Math.lerp_point(self.anchor_1.handle_point.position, self.anchor_2.handle_point.position, percentage)
@@ -146,25 +268,43 @@ class BezeirCurve(Entity):
         center_2_2 = Math.lerp_point(center_1_2, center_1_3, percentage)
 
         return Math.lerp_point(center_2_1, center_2_2, percentage)
-    
-    def recalculate_curve(self):
-        part = 1 / self.iteration
 
-        self.lines.clear()
-        
-        # point_start = self.sample(0)
-        # point_end = (0, 0)
-        self.lines.append(self.sample(0))
-        for i in range(1, self.iteration):
-            point_end = self.sample(i * part)
+    @staticmethod
+    def bernstein_sample(control_points, percentages) -> np.ndarray:
+        # Every percentage at once, cubic Bernstein basis (n, 4) times control points (4, 2)
+        percentages = np.asarray(percentages, dtype=float)
+        inverse = 1 - percentages
+        basis = np.stack((
+            inverse * inverse * inverse,
+            3 * percentages * inverse * inverse,
+            3 * percentages * percentages * inverse,
+            percentages * percentages * percentages), axis=-1)
+        return basis @ np.asarray(control_points, dtype=float)
+
+    @staticmethod
+    def flatten_percentages(control_points, tolerance: float, max_depth: int=MAX_SUBDIVISION_DEPTH) -> np.ndarray:
+        # Wang's bound, n even steps keep a cubic within 3/4 * M / n^2 of its polyline, M being the
+        # larger second difference of the control points. Tight or big curves get more points, and
+        # it costs a few float ops instead of a subdivision loop
+        (x_0, y_0), (x_1, y_1), (x_2, y_2), (x_3, y_3) = control_points
+        second_difference = max(math.hypot(x_0 - 2 * x_1 + x_2, y_0 - 2 * y_1 + y_2),
+                                math.hypot(x_1 - 2 * x_2 + x_3, y_1 - 2 * y_2 + y_3))
+
+        steps = math.ceil(math.sqrt(0.75 * second_difference / tolerance))
+        return np.linspace(0, 1, min(max(steps, 1), 1 << max_depth) + 1)
 
-            # self.lines.append((point_start, point_end))
-            self.lines.append(self.sample(i * part))
+    def recalculate_curve(self):
+        control_points = self.control_points()
+        if control_points == self.cached_control_points:
+            return
+        self.cached_control_points = control_points
 
-            point_start = point_end
-        
-        self.lines.append(self.sample(1))
-        # self.lines.append((point_start, self.sample(1)))
+        if self.tolerance is None:
+            percentages = np.linspace(0, 1, self.iteration + 1)
+        else:
+            percentages = self.flatten_percentages(control_points, self.tolerance)
+
+        self.lines = [tuple(point) for point in self.bernstein_sample(control_points, percentages).tolist()]
     
     def update(self, delta_time: float):
         self.anchor_1.update(delta_time)
@@ -172,6 +312,12 @@ class BezeirCurve(Entity):
 
         if self.anchor_1.has_change or self.anchor_2.has_change:
             self.recalculate_curve()
+
+    def is_dirty(self) -> bool:
+        return self.anchor_1.is_dirty() or self.anchor_2.is_dirty()
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        return Math.bounding_rect(self.lines, 1).union(self.anchor_1.bounding_rect()).union(self.anchor_2.bounding_rect())
     
     def draw(self, window: "ManagedWindow"):
         self.anchor_1.draw(window)
@@ -182,9 +328,181 @@ class BezeirCurve(Entity):
         pygame.draw.lines(window.surface, Color.WHITE, False, self.lines)
 
 
+class BezeirSpline(Entity):
+    # Chain of cubic segments, segment i runs from anchors[i] to anchors[i + 1].
+    # An anchor's handle is its outgoing control point, the incoming one is the
+    # handle mirrored around the pivot, so the path stays smooth through every anchor
+    def __init__(self, anchors: List[Anchor]=None, table_size=32):
+        self.anchors: List[Anchor] = []
+        self.table_size = table_size
+        self.line_color = Color.WHITE
+
+        # Per segment: control points it was built from, cumulative arc length table, polyline and bounds
+        self.segment_control_points: List[Tuple[Vector, Vector, Vector, Vector]] = []
+        self.segment_tables: List[np.ndarray] = []
+        self.segment_lines: List[List[Vector]] = []
+        self.segment_rects: List[pygame.Rect] = []
+
+        self.segment_lengths = np.zeros(0)
+        self.segment_offsets = np.zeros(1)
+        self.percentage_table = np.linspace(0, 1, table_size + 1)
+
+        self.has_change = False
+        self.drawn = False
+
+        for anchor in anchors or []:
+            self.add_anchor(anchor)
+
+    @property
+    def total_length(self) -> float:
+        return float(self.segment_offsets[-1])
+
+    @property
+    def segment_count(self) -> int:
+        return len(self.segment_tables)
+
+    def add_anchor(self, anchor: Anchor):
+        self.anchors.append(anchor)
+        if len(self.anchors) < 2:
+            return
+
+        self.segment_control_points.append(None)
+        self.segment_tables.append(None)
+        self.segment_lines.append(None)
+        self.segment_rects.append(None)
+        self.segment_lengths = np.append(self.segment_lengths, 0)
+
+        self.rebuild_segment(self.segment_count - 1)
+        self.rebuild_offsets()
+
+    def control_points(self, segment: int) -> Tuple[Vector, Vector, Vector, Vector]:
+        start = self.anchors[segment]
+        end = self.anchors[segment + 1]
+
+        end_pivot = end.piviot_point.position
+        end_handle = end.handle_point.position
+        incoming_handle = (2 * end_pivot[0] - end_handle[0], 2 * end_pivot[1] - end_handle[1])
+
+        return (start.piviot_point.position, start.handle_point.position, incoming_handle, end_pivot)
+
+    def rebuild_segment(self, segment: int) -> bool:
+        control_points = self.control_points(segment)
+        if control_points == self.segment_control_points[segment]:
+            return False
+
+        points = BezeirCurve.bernstein_sample(control_points, self.percentage_table)
+        steps = np.diff(points, axis=0)
+
+        table = np.zeros(self.table_size + 1)
+        np.cumsum(np.hypot(steps[:, 0], steps[:, 1]), out=table[1:])
+
+        self.segment_control_points[segment] = control_points
+        self.segment_tables[segment] = table
+        self.segment_lines[segment] = [tuple(point) for point in points.tolist()]
+        self.segment_rects[segment] = Math.bounding_rect(points, 1)
+        self.segment_lengths[segment] = table[-1]
+        return True
+
+    def rebuild_offsets(self):
+        self.segment_offsets = np.zeros(self.segment_count + 1)
+        np.cumsum(self.segment_lengths, out=self.segment_offsets[1:])
+
+    def position_at_distance(self, distance: float) -> Vector:
+        if self.segment_count == 0:
+            return self.anchors[0].piviot_point.position
+
+        distance = min(max(distance, 0), self.total_length)
+
+        segment = int(np.searchsorted(self.segment_offsets, distance, side="right")) - 1
+        segment = min(segment, self.segment_count - 1)
+        local_distance = distance - self.segment_offsets[segment]
+
+        # Binary search the arc length table, then interpolate t linearly inside the step
+        table = self.segment_tables[segment]
+        step = min(int(np.searchsorted(table, local_distance, side="right")) - 1, self.table_size - 1)
+        step_length = table[step + 1] - table[step]
+        fraction = (local_distance - table[step]) / step_length if step_length > 0 else 0
+
+        percentage = (step + fraction) / self.table_size
+        return tuple(BezeirCurve.bernstein_sample(self.segment_control_points[segment], [percentage])[0].tolist())
+
+    def update(self, delta_time: float):
+        self.has_change = False
+
+        changed_segments = set()
+        for index, anchor in enumerate(self.anchors):
+            anchor.update(delta_time)
+
+            # Only the two segments touching a moved anchor need new tables
+            if anchor.has_change:
+                if index > 0:
+                    changed_segments.add(index - 1)
+                if index < self.segment_count:
+                    changed_segments.add(index)
+
+        for segment in changed_segments:
+            if self.rebuild_segment(segment):
+                self.has_change = True
+
+        if self.has_change:
+            self.rebuild_offsets()
+            self.drawn = False
+
+    def is_dirty(self) -> bool:
+        return not self.drawn or any(anchor.is_dirty() for anchor in self.anchors)
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        rects = [anchor.bounding_rect() for anchor in self.anchors]
+        return rects[0].unionall(rects[1:] + self.segment_rects) if rects else None
+
+    def draw(self, window: "ManagedWindow"):
+        self.drawn = True
+
+        for anchor in self.anchors:
+            anchor.draw(window)
+
+        for lines in self.segment_lines:
+            pygame.draw.lines(window.surface, self.line_color, False, lines)
+
+
+class SplineFollower(Entity):
+    # Moves along a spline at a constant speed in pixels per second, looping at the end
+    def __init__(self, spline: BezeirSpline, speed=100, distance=0, color=None, radius=6):
+        self.spline = spline
+        self.speed = speed
+        self.distance = distance
+
+        self.color = Color.YELLOW if color is None else color
+        self.radius = radius
+        self.position = spline.position_at_distance(distance)
+
+    def update(self, delta_time: float):
+        total_length = self.spline.total_length
+        if total_length > 0:
+            self.distance = (self.distance + self.speed * delta_time) % total_length
+        self.position = self.spline.position_at_distance(self.distance)
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        return Math.bounding_rect(self.position, self.radius + 1)
+
+    def draw(self, window: "ManagedWindow"):
+        SHAPES.draw_circle(window.surface, self.color, self.position, self.radius)
+
+
 if __name__ == "__main__":
-    window = ManagedWindow((700, 700))
-    bezeir = BezeirCurve(Anchor((150, 150), (150, 200)), Anchor((250, 150), (250, 200)))
-    window.children.append(BezeirCurveDebug(bezeir.anchor_1, bezeir.anchor_2))
-    window.children.append(bezeir)
+    window = ManagedWindow((700, 700), dirty_rects=True)
+
+    if "--spline" in sys.argv:
+        point_group = ClickablePointGroup()
+        spline = BezeirSpline([
+            Anchor((x, 200 + (x // 60 % 2) * 300), (x + 30, 350), point_group=point_group)
+            for x in range(40, 700, 60)])
+        window.children.append(point_group)
+        window.children.append(spline)
+        window.children.append(SplineFollower(spline, speed=150))
+    else:
+        bezeir = BezeirCurve(Anchor((150, 150), (150, 200)), Anchor((250, 150), (250, 200)))
+        window.children.append(BezeirCurveDebug(bezeir.anchor_1, bezeir.anchor_2))
+        window.children.append(bezeir)
+
     window.run()
@@ -1,178 +1,671 @@
 import pygame
+import numpy as np
+import sys
 
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 try:
-    from .foundation import ManagedWindow, Entity, Color, Math, Vector
+    from .foundation import ManagedWindow, Entity, InputSystem, Color, Math, Vector
+    from .bezier_curve import ClickablePoint
+    from .spatial import UniformGrid
+    from .batch_render import draw_circles, draw_segments, map_color
 except ImportError:
-    from foundation import ManagedWindow, Entity, Color, Math, Vector
+    from foundation import ManagedWindow, Entity, InputSystem, Color, Math, Vector
+    from bezier_curve import ClickablePoint
+    from spatial import UniformGrid
+    from batch_render import draw_circles, draw_segments, map_color
 
-class ClothNode:
-    def __init__(self, position, velocity=(0, 0), acceration=(0, 0), magnitude=0, fixed=False) -> None:
-        self.position = position
-        self.velocity = velocity
-        self.acceration = acceration
-        self.magnitude = magnitude
-        self.mass = 1
 
-        self.fixed = fixed
+class CircleObstacle(ClickablePoint):
+    # Dragged around like a ClickablePoint, the cloth reads where it is every step
+    def __init__(self, position, radius=20, color=None, **kwargs):
+        kwargs.setdefault("range", radius)
+        super().__init__(position, color=color, radius=radius, **kwargs)
 
+    def update(self, delta_time: float):
+        super().update(delta_time)
+
+        if self.status == 2:
+            self.position = InputSystem.MOUSE_POS
+
+    def push_out(self, positions: np.ndarray, free: np.ndarray, margin: float) -> Tuple[np.ndarray, np.ndarray]:
+        # Moves the free nodes inside onto the surface, returns them with the surface normals
+        reach = self.radius + margin
+        delta = positions - self.position
+        sqr_distance = np.einsum("ij,ij->i", delta, delta)
+
+        inside = np.flatnonzero(free & (sqr_distance < reach * reach))
+        distance = np.sqrt(sqr_distance[inside])[:, None]
+        normals = np.divide(delta[inside], distance, out=np.tile((0.0, -1.0), (len(inside), 1)),
+                            where=distance > ClothEngine.EPSILON)
+
+        positions[inside] = np.asarray(self.position, dtype=float) + normals * reach
+        return inside, normals
+
+
+class RectObstacle(ClickablePoint):
+    # `position` is the center of the rectangle
+    def __init__(self, position, size=(60, 20), color=None, **kwargs):
+        self.size = size
+        super().__init__(position, color=color, **kwargs)
+
+    def rect(self) -> pygame.Rect:
+        rect = pygame.Rect(0, 0, *self.size)
+        rect.center = self.position
+        return rect
+
+    def hit(self, position: Vector) -> bool:
+        return self.rect().collidepoint(position)
+
+    def update(self, delta_time: float):
+        super().update(delta_time)
+
+        if self.status == 2:
+            self.position = InputSystem.MOUSE_POS
+
+    def push_out(self, positions: np.ndarray, free: np.ndarray, margin: float) -> Tuple[np.ndarray, np.ndarray]:
+        # Nodes inside leave through the closest side
+        half_size = np.asarray(self.size, dtype=float) / 2 + margin
+        local = positions - self.position
+        depth = half_size - np.abs(local)
+
+        inside = np.flatnonzero(free & (depth > 0).all(axis=1))
+        axis = np.argmin(depth[inside], axis=1)
+        side = np.where(local[inside, axis] < 0, -1.0, 1.0)
+
+        normals = np.zeros((len(inside), 2))
+        normals[np.arange(len(inside)), axis] = side
+        positions[inside, axis] = np.asarray(self.position, dtype=float)[axis] + side * half_size[axis]
+        return inside, normals
 
-class NodeConnection:
-    def __init__(self, first_node:ClothNode, second_node:ClothNode):
-        self.first_node: ClothNode = first_node
-        self.second_node: ClothNode = second_node
+    def draw_state(self):
+        return (*super().draw_state(), tuple(self.size))
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        return self.rect().inflate(self.width + 2, self.width + 2)
+
+    def draw(self, window: "ManagedWindow"):
+        if self.status == 0:
+            pygame.draw.rect(window.surface, self.color, self.rect(), self.width)
+        elif self.status == 1:
+            pygame.draw.rect(window.surface, self.hover_color, self.rect(), self.width)
+        elif self.status == 2:
+            pygame.draw.rect(window.surface, self.click_color, self.rect(), self.width)
+        self.drawn_state = self.draw_state()
+
+
+class ClothEngine:
+    EPSILON = 1e-9
+
+    SPRING = "spring"
+    VERLET = "verlet"
+
+    def __init__(self, capacity=64, solver=SPRING, iterations=8) -> None:
+        self.node_count = 0
+        self.connection_count = 0
+
+        self.solver = solver
+        self.iterations = iterations
+        self.damping = 0.99
+        self.stiffness = 1
+
+        self._positions = np.zeros((capacity, 2))
+        self._previous_positions = np.zeros((capacity, 2))
+        self._velocities = np.zeros((capacity, 2))
+        self._accelerations = np.zeros((capacity, 2))
+        self._fixed = np.zeros(capacity, dtype=bool)
+
+        self._connections = np.zeros((capacity, 2), dtype=np.intp)
+        self._lengths = np.zeros(capacity)
 
-        self.length = Math.magnitude(self.first_node.position, self.second_node.position)
         self.flexable_min = 0.9
         self.flexable_max = 1.1
-    
-    def clamp_second_node_position(self):
-        if self.first_node.fixed and self.second_node.fixed:
+
+        self.previous_valid = False
+
+        # Edge colouring kept up to date as connections come and go, no two connections of a
+        # colour share a node so each colour batch is solved in one vectorized pass
+        self._colors = np.zeros(capacity, dtype=np.intp)
+        self._batch_slots = np.zeros(capacity, dtype=np.intp)
+        self.batch_members: List[np.ndarray] = []
+        self.batch_sizes: List[int] = []
+        self.node_color_masks: List[int] = []
+
+        # Connections stretched past `length * tear_ratio` break, None keeps the cloth whole
+        self.tear_ratio: Optional[float] = None
+
+        # Nodes are treated as discs of `collision_radius` against obstacles and each other
+        self.obstacles: List[CircleObstacle | RectObstacle] = []
+        self.self_collision = False
+        self.collision_radius = 4
+        self.collision_grid = UniformGrid()
+        self.connection_keys: np.ndarray = None
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self._positions[:self.node_count]
+
+    @property
+    def velocities(self) -> np.ndarray:
+        return self._velocities[:self.node_count]
+
+    @property
+    def accelerations(self) -> np.ndarray:
+        return self._accelerations[:self.node_count]
+
+    @property
+    def fixed(self) -> np.ndarray:
+        return self._fixed[:self.node_count]
+
+    @property
+    def connections(self) -> np.ndarray:
+        return self._connections[:self.connection_count]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self._lengths[:self.connection_count]
+
+    @property
+    def color_batches(self) -> List[np.ndarray]:
+        return [members[:size] for members, size in zip(self.batch_members, self.batch_sizes) if size > 0]
+
+    def add_nodes(self, positions, fixed=False) -> np.ndarray:
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        start = self.node_count
+        end = start + len(positions)
+
+        self._positions = Math.grow_array(self._positions, end)
+        self._previous_positions = Math.grow_array(self._previous_positions, end)
+        self._velocities = Math.grow_array(self._velocities, end)
+        self._accelerations = Math.grow_array(self._accelerations, end)
+        self._fixed = Math.grow_array(self._fixed, end)
+
+        self._positions[start:end] = positions
+        self._previous_positions[start:end] = positions
+        self._velocities[start:end] = 0
+        self._accelerations[start:end] = 0
+        self._fixed[start:end] = fixed
+        self.node_color_masks.extend([0] * (end - start))
+        self.node_count = end
+
+        return np.arange(start, end)
+
+    def add_node(self, position, fixed=False) -> int:
+        return int(self.add_nodes([position], fixed=fixed)[0])
+
+    def connect_many(self, first_nodes, second_nodes) -> np.ndarray:
+        first_nodes = np.asarray(first_nodes, dtype=np.intp).ravel()
+        second_nodes = np.asarray(second_nodes, dtype=np.intp).ravel()
+        start = self.connection_count
+        end = start + len(first_nodes)
+
+        self._connections = Math.grow_array(self._connections, end)
+        self._lengths = Math.grow_array(self._lengths, end)
+        self._colors = Math.grow_array(self._colors, end)
+        self._batch_slots = Math.grow_array(self._batch_slots, end)
+
+        self._connections[start:end, 0] = first_nodes
+        self._connections[start:end, 1] = second_nodes
+        delta = self._positions[second_nodes] - self._positions[first_nodes]
+        self._lengths[start:end] = np.hypot(delta[:, 0], delta[:, 1])
+        self.connection_count = end
+        self.connection_keys = None
+        self.color_connections(start, end)
+
+        return np.arange(start, end)
+
+    def connect(self, first_node: int, second_node: int) -> int:
+        return int(self.connect_many([first_node], [second_node])[0])
+
+    def color_connections(self, start: int, end: int):
+        # Greedy edge colouring, every node keeps a bit mask of the colours its connections
+        # hold and a new connection takes the lowest colour free at both ends
+        masks = self.node_color_masks
+
+        for index, (first, second) in enumerate(self._connections[start:end].tolist(), start):
+            taken = masks[first] | masks[second]
+            color = (~taken & (taken + 1)).bit_length() - 1
+            masks[first] |= 1 << color
+            masks[second] |= 1 << color
+
+            if color == len(self.batch_members):
+                self.batch_members.append(np.zeros(16, dtype=np.intp))
+                self.batch_sizes.append(0)
+
+            slot = self.batch_sizes[color]
+            self.batch_members[color] = Math.grow_array(self.batch_members[color], slot + 1)
+            self.batch_members[color][slot] = index
+            self.batch_sizes[color] = slot + 1
+
+            self._colors[index] = color
+            self._batch_slots[index] = slot
+
+    def remove_connection(self, index: int):
+        # Swap-remove, both from the colour batch and from the connection arrays, so
+        # removing is O(1) and the arrays stay packed for the solver and for drawing
+        first, second = self._connections[index].tolist()
+        color = int(self._colors[index])
+        slot = int(self._batch_slots[index])
+        self.node_color_masks[first] &= ~(1 << color)
+        self.node_color_masks[second] &= ~(1 << color)
+
+        members = self.batch_members[color]
+        last_slot = self.batch_sizes[color] - 1
+        moved = members[last_slot]
+        members[slot] = moved
+        self._batch_slots[moved] = slot
+        self.batch_sizes[color] = last_slot
+
+        last = self.connection_count - 1
+        if index != last:
+            self._connections[index] = self._connections[last]
+            self._lengths[index] = self._lengths[last]
+            self._colors[index] = self._colors[last]
+            self._batch_slots[index] = self._batch_slots[last]
+            self.batch_members[self._colors[index]][self._batch_slots[index]] = index
+
+            if self.connection_keys is not None:
+                self.connection_keys[index] = self.connection_keys[last]
+
+        self.connection_count = last
+        if self.connection_keys is not None:
+            self.connection_keys = self.connection_keys[:last]
+
+    def remove_connections(self, indices):
+        # Highest index first, so the connection moved into a hole is never one still to be removed
+        for index in sorted(set(np.asarray(indices, dtype=np.intp).ravel().tolist()), reverse=True):
+            self.remove_connection(index)
+
+    def tear(self) -> np.ndarray:
+        if self.tear_ratio is None or self.connection_count == 0:
+            return np.zeros(0, dtype=np.intp)
+
+        positions = self.positions
+        delta = positions[self.connections[:, 1]] - positions[self.connections[:, 0]]
+        broken = np.flatnonzero(np.hypot(delta[:, 0], delta[:, 1]) > self.lengths * self.tear_ratio)
+
+        self.remove_connections(broken)
+        return broken
+
+    def rebuild_batches(self):
+        # Puts the colour batches back from the per connection colours and slots, a restored
+        # state then solves in exactly the order it did when it was recorded
+        colors = self._colors[:self.connection_count]
+        slots = self._batch_slots[:self.connection_count]
+        color_count = int(colors.max()) + 1 if self.connection_count else 0
+
+        self.batch_sizes = np.bincount(colors, minlength=color_count).tolist()
+        self.batch_members = []
+        for color, size in enumerate(self.batch_sizes):
+            members = np.zeros(max(size, 16), dtype=np.intp)
+            in_color = np.flatnonzero(colors == color)
+            members[slots[in_color]] = in_color
+            self.batch_members.append(members)
+
+        masks = [0] * self.node_count
+        for (first, second), color in zip(self.connections.tolist(), colors.tolist()):
+            masks[first] |= 1 << color
+            masks[second] |= 1 << color
+        self.node_color_masks = masks
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        # The connection arrays go in at their full capacity with the live count beside them,
+        # a tear then only changes the count and a recorder keeps stacking frames into one chunk
+        return {
+            "positions": self.positions,
+            "previous_positions": self._previous_positions[:self.node_count],
+            "velocities": self.velocities,
+            "accelerations": self.accelerations,
+            "fixed": self.fixed,
+            "previous_valid": np.array(self.previous_valid),
+            "connections": self._connections,
+            "lengths": self._lengths,
+            "colors": self._colors,
+            "batch_slots": self._batch_slots,
+            "connection_count": np.array(self.connection_count),
+        }
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        node_count = len(state["positions"])
+        self._positions = Math.grow_array(self._positions, node_count)
+        self._previous_positions = Math.grow_array(self._previous_positions, node_count)
+        self._velocities = Math.grow_array(self._velocities, node_count)
+        self._accelerations = Math.grow_array(self._accelerations, node_count)
+        self._fixed = Math.grow_array(self._fixed, node_count)
+        self.node_count = node_count
+
+        self.positions[:] = state["positions"]
+        self._previous_positions[:node_count] = state["previous_positions"]
+        self.velocities[:] = state["velocities"]
+        self.accelerations[:] = state["accelerations"]
+        self.fixed[:] = state["fixed"]
+        self.previous_valid = bool(state["previous_valid"])
+
+        # Copied whole, the unused tail included, so a replay records the same frames again
+        self._connections = np.array(state["connections"], dtype=np.intp)
+        self._lengths = np.array(state["lengths"], dtype=float)
+        self._colors = np.array(state["colors"], dtype=np.intp)
+        self._batch_slots = np.array(state["batch_slots"], dtype=np.intp)
+        self.connection_count = int(state["connection_count"])
+        self.connection_keys = None
+        self.rebuild_batches()
+
+    def _scatter_add(self, target: np.ndarray, indices: np.ndarray, values: np.ndarray):
+        target[:, 0] += np.bincount(indices, weights=values[:, 0], minlength=len(target))
+        target[:, 1] += np.bincount(indices, weights=values[:, 1], minlength=len(target))
+
+    def solve_connections(self):
+        # Over-stretched connections are pulled back to `length * flexable_max`, then every
+        # connection pushes its free ends towards the rest length through acceleration. One colour
+        # batch at a time like the old per connection loop, a node sharing several stretched
+        # connections would be pulled by all of them at once and overshoot
+        if self.connection_count == 0:
             return
 
-        elif self.first_node.fixed and not self.second_node.fixed:
-            position_delta = Math.tuple_minus(self.second_node.position, self.first_node.position)
-            self.second_node.position = Math.tuple_plus(self.first_node.position, Math.clamp_magnitude(
-                position_delta, self.length * self.flexable_max,
-                clamp_when_distance_over=True))
+        positions = self.positions
+        accelerations = self.accelerations
+        free = (~self.fixed).astype(float)
+
+        for batch in self.color_batches:
+            first = self._connections[batch, 0]
+            second = self._connections[batch, 1]
+            lengths = self._lengths[batch]
+
+            free_first = free[first]
+            free_second = free[second]
+            free_total = free_first + free_second
+
+            first_positions = positions[first]
+            second_positions = positions[second]
+            delta = second_positions - first_positions
+            distance = np.hypot(delta[:, 0], delta[:, 1])
+            direction = delta / np.maximum(distance, self.EPSILON)[:, None]
+
+            max_length = lengths * self.flexable_max
+            excess = np.maximum(distance - max_length, 0)
+
+            # Split the position fix between the free ends, a fixed end takes none of it
+            share_first = np.divide(free_first, free_total, out=np.zeros_like(free_first), where=free_total > 0)
+            share_second = np.divide(free_second, free_total, out=np.zeros_like(free_second), where=free_total > 0)
+
+            # Inside a batch the nodes are distinct, so the fancy index writes never collide
+            positions[first] = first_positions + direction * (excess * share_first)[:, None]
+            positions[second] = second_positions - direction * (excess * share_second)[:, None]
+
+            spring = direction * (lengths - np.minimum(distance, max_length))[:, None]
+            accelerations[second] += spring * free_second[:, None]
+            accelerations[first] -= spring * free_first[:, None]
+
+    def gather_batches(self) -> List[Tuple[np.ndarray, ...]]:
+        # Everything the projection needs per batch, gathered once per step instead of per iteration
+        inverse_mass = (~self.fixed).astype(float)
+        batches = []
+
+        for batch in self.color_batches:
+            first = self._connections[batch, 0]
+            second = self._connections[batch, 1]
+            weight_first = inverse_mass[first]
+            weight_second = inverse_mass[second]
+            weight_total = weight_first + weight_second
+
+            movable = weight_total > 0
+            share_first = (weight_first[movable] / weight_total[movable] * self.stiffness)[:, None]
+            share_second = (weight_second[movable] / weight_total[movable] * self.stiffness)[:, None]
+            batches.append((first[movable], second[movable], self._lengths[batch][movable], share_first, share_second))
+
+        return batches
+
+    def project_constraints(self, batches: List[Tuple[np.ndarray, ...]]):
+        # Inside a colour batch the nodes are distinct, so the fancy index writes never collide
+        positions = self.positions
+
+        for first, second, lengths, share_first, share_second in batches:
+            first_positions = positions[first]
+            second_positions = positions[second]
+
+            correction = second_positions - first_positions
+            distance = np.sqrt(np.einsum("ij,ij->i", correction, correction))
+            np.maximum(distance, self.EPSILON, out=distance)
+            correction *= ((distance - lengths) / distance)[:, None]
+
+            first_positions += correction * share_first
+            second_positions -= correction * share_second
+            positions[first] = first_positions
+            positions[second] = second_positions
+
+    @property
+    def has_collisions(self) -> bool:
+        return self.self_collision or bool(self.obstacles)
 
-            new_delta = Math.clamp_magnitude(position_delta, self.length)
-            new_position = Math.tuple_plus(self.first_node.position, new_delta)
+    @staticmethod
+    def pair_keys(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        # One int64 per (first, second) pair, independent of the node count so adding nodes
+        # keeps the cached connection keys valid
+        return (first.astype(np.int64) << 32) | second.astype(np.int64)
 
-            self.second_node.acceration = Math.tuple_plus(self.second_node.acceration, Math.tuple_minus(new_position, self.second_node.position))
+    def find_collision_pairs(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # Broad phase once per step, with some slack so pairs closing in during the iterations are kept
+        if not self.self_collision:
+            return None
 
-        elif not self.first_node.fixed and self.second_node.fixed:
-            position_delta = Math.tuple_minus(self.first_node.position, self.second_node.position)
-            self.first_node.position = Math.tuple_plus(self.second_node.position, Math.clamp_magnitude(
-                position_delta, self.length * self.flexable_max,
-                clamp_when_distance_over=True))
+        search_radius = self.collision_radius * 3
+        self.collision_grid.cell_size = search_radius
+        self.collision_grid.rebuild(self.positions)
+        first, second = self.collision_grid.query_pairs(search_radius)
 
-            new_delta = Math.clamp_magnitude(position_delta, self.length)
-            new_position = Math.tuple_plus(self.second_node.position, new_delta)
+        # Connected nodes are already kept apart by their connection
+        if self.connection_keys is None:
+            connections = self.connections
+            self.connection_keys = self.pair_keys(np.minimum(connections[:, 0], connections[:, 1]),
+                                                  np.maximum(connections[:, 0], connections[:, 1]))
 
-            self.first_node.acceration = Math.tuple_plus(self.first_node.acceration, Math.tuple_minus(new_position, self.first_node.position))
-        
-        else:
-            position_delta = Math.tuple_minus(self.second_node.position, self.first_node.position)
+        unconnected = ~np.isin(self.pair_keys(first, second), self.connection_keys)
+        return first[unconnected], second[unconnected]
 
-            magnitude = Math.magnitude(position_delta)
-            if magnitude > self.length * self.flexable_max:
-                self.first_node.position, self.second_node.position = self.pull_two_point_together(
-                    self.first_node.position, self.second_node.position, self.length * self.flexable_max)
+    def solve_self_collisions(self, first: np.ndarray, second: np.ndarray):
+        # A node can touch several others, so corrections are summed instead of written
+        positions = self.positions
+        inverse_mass = (~self.fixed).astype(float)
 
-            new_delta = Math.clamp_magnitude(position_delta, self.length)
-            new_position = Math.tuple_plus(self.first_node.position, new_delta)
-            self.second_node.acceration = Math.tuple_plus(self.second_node.acceration, Math.tuple_minus(new_position, self.second_node.position))
+        delta = positions[second] - positions[first]
+        distance = np.sqrt(np.einsum("ij,ij->i", delta, delta))
+        overlap = self.collision_radius * 2 - distance
+        weight_total = inverse_mass[first] + inverse_mass[second]
 
-            new_delta = Math.clamp_magnitude(Math.tuple_multiple(position_delta, -1), self.length)
-            new_position = Math.tuple_plus(self.second_node.position, new_delta)
-            self.first_node.acceration = Math.tuple_plus(self.first_node.acceration, Math.tuple_minus(new_position, self.first_node.position))
+        touching = (overlap > 0) & (weight_total > 0)
+        first = first[touching]
+        second = second[touching]
 
-    @staticmethod
-    def pull_two_point_together(point_a, point_b, length_constain) -> Tuple[Vector, Vector]:
-        center_position = Math.lerp_point(point_a, point_b, 0.5)
+        direction = delta[touching] / np.maximum(distance[touching], self.EPSILON)[:, None]
+        correction = direction * (overlap[touching] / weight_total[touching])[:, None]
+
+        self._scatter_add(positions, first, correction * -inverse_mass[first][:, None])
+        self._scatter_add(positions, second, correction * inverse_mass[second][:, None])
+
+    def solve_collisions(self, pairs: Optional[Tuple[np.ndarray, np.ndarray]]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if pairs is not None:
+            self.solve_self_collisions(*pairs)
 
-        point_a = Math.tuple_plus(center_position, Math.clamp_magnitude(
-            Math.tuple_minus(point_a, center_position), length_constain / 2,
-            clamp_when_distance_over=True))
+        free = ~self.fixed
+        return [obstacle.push_out(self.positions, free, self.collision_radius) for obstacle in self.obstacles]
 
-        point_b = Math.tuple_plus(center_position, Math.clamp_magnitude(
-            Math.tuple_minus(point_b, center_position), length_constain / 2,
-            clamp_when_distance_over=True))
-        
-        return point_a, point_b
+    def step_verlet(self, delta_time: float, gravity: Vector):
+        positions = self.positions
+        previous_positions = self._previous_positions[:self.node_count]
+        free = ~self.fixed
+
+        if not self.previous_valid:
+            # Coming from the spring solver or fresh nodes, carry the current velocity over
+            previous_positions[:] = positions - self.velocities * delta_time
+            self.previous_valid = True
+
+        motion = (positions - previous_positions) * self.damping
+        previous_positions[:] = positions
+        positions[free] += motion[free] + np.asarray(gravity, dtype=float) * (delta_time * delta_time)
+
+        batches = self.gather_batches()
+        pairs = self.find_collision_pairs()
+
+        for _ in range(self.iterations):
+            self.project_constraints(batches)
+
+            if self.has_collisions:
+                self.solve_collisions(pairs)
+
+        self.velocities[:] = (positions - previous_positions) / delta_time
+
+    def step_spring(self, delta_time: float, gravity: Vector):
+        self.previous_valid = False
+        self.solve_connections()
+
+        accelerations = self.accelerations
+        accelerations[~self.fixed] += gravity
+
+        velocities = self.velocities
+        velocities += accelerations * delta_time
+        positions = self.positions
+        positions += velocities * delta_time
+
+        accelerations[:] = 0
+
+        if self.has_collisions:
+            for indices, normals in self.solve_collisions(self.find_collision_pairs()):
+                # Moving into an obstacle is cancelled, sliding along it is kept
+                inward = np.minimum(np.einsum("ij,ij->i", velocities[indices], normals), 0)
+                velocities[indices] -= normals * inward[:, None]
+
+    def step(self, delta_time: float, gravity: Vector):
+        if self.solver == self.VERLET:
+            self.step_verlet(delta_time, gravity)
+        else:
+            self.step_spring(delta_time, gravity)
+
+        self.tear()
 
 
 class Cloth(Entity):
-    def __init__(self) -> None:
-        self.points: List[ClothNode] = []
-        self.connections: List[NodeConnection] = []
+    independent = True
+
+    def __init__(self, x_size=5, y_size=5, solver=ClothEngine.SPRING, iterations=8, tear_ratio=None) -> None:
+        self.engine = ClothEngine(solver=solver, iterations=iterations)
+        self.engine.tear_ratio = tear_ratio
 
-        self.set_2()
+        self.set_2(x_size, y_size)
 
         self.gravity = (0, 10)
-    
+        self.previous_positions: np.ndarray = None
+
+        self.step_count = 0
+        self.drawn_step = None
+
     def set_1(self):
-        self.points.append(ClothNode((150, 40), fixed=True))
-        self.points.append(ClothNode((130, 60), fixed=True))
-        self.points.append(ClothNode((170, 60)))
-        self.points.append(ClothNode((150, 80)))
-
-        self.connect_point(self.points[0], self.points[1])
-        self.connect_point(self.points[0], self.points[2])
-        self.connect_point(self.points[1], self.points[3])
-        self.connect_point(self.points[2], self.points[3])
-    
-    def set_2(self):
-        x_size = 5
-        y_size = 5
-
-        point_matrix = [[None for i in range(x_size)] for e in range(y_size)]
+        top = self.add_point((150, 40), fixed=True)
+        left = self.add_point((130, 60), fixed=True)
+        right = self.add_point((170, 60))
+        bottom = self.add_point((150, 80))
 
+        self.connect_point(top, left)
+        self.connect_point(top, right)
+        self.connect_point(left, bottom)
+        self.connect_point(right, bottom)
+
+    def set_2(self, x_size=5, y_size=5):
         base_x = 100
         base_y = 40
         x_increment = 20
         y_increment = 20
 
-        for x in range(x_size):
-            for y in range(y_size):
-                window_x = x * x_increment + base_x
-                window_y = y * y_increment + base_y
-                point_matrix[y][x] = ClothNode((window_x, window_y))
-                self.points.append(point_matrix[y][x])
-
-        point_matrix[0][0].fixed = True
-        point_matrix[0][-1].fixed = True
-        # point_matrix[-1][0].fixed = True
-        # point_matrix[-1][-1].fixed = True
-
-        for y in range(y_size - 1):
-            for x in range(x_size - 1):
-                self.connect_point(point_matrix[y][x], point_matrix[y][x + 1])
-                self.connect_point(point_matrix[y][x], point_matrix[y + 1][x])
-
-        for x in range(x_size - 1):
-            self.connect_point(point_matrix[-1][x], point_matrix[-1][x + 1])
-        for y in range(y_size - 1):
-            self.connect_point(point_matrix[y][-1], point_matrix[y + 1][-1])
-    
-    def connect_point(self, first_node, second_node):
-        self.connections.append(NodeConnection(
-            first_node=first_node,
-            second_node=second_node))
+        window_x, window_y = np.meshgrid(
+            np.arange(x_size) * x_increment + base_x,
+            np.arange(y_size) * y_increment + base_y)
+        point_matrix = self.engine.add_nodes(np.stack((window_x, window_y), axis=-1)).reshape(y_size, x_size)
+
+        self.engine.fixed[point_matrix[0][0]] = True
+        self.engine.fixed[point_matrix[0][-1]] = True
+        # self.engine.fixed[point_matrix[-1][0]] = True
+        # self.engine.fixed[point_matrix[-1][-1]] = True
+
+        self.engine.connect_many(point_matrix[:, :-1], point_matrix[:, 1:])
+        self.engine.connect_many(point_matrix[:-1, :], point_matrix[1:, :])
+
+    def add_point(self, position, fixed=False) -> int:
+        return self.engine.add_node(position, fixed=fixed)
+
+    def connect_point(self, first_node: int, second_node: int):
+        self.engine.connect(first_node, second_node)
+
+    def add_obstacle(self, obstacle: CircleObstacle | RectObstacle):
+        # Workers step before the window's serial pass that moves the obstacle, a threaded cloth
+        # would collide with where the obstacle was a step ago
+        self.engine.obstacles.append(obstacle)
+        self.independent = False
 
     def update(self, delta_time: float):
-        for connection in self.connections:
-            connection.clamp_second_node_position()
-
-        for i, point in enumerate(self.points):
-            if not point.fixed:
-                point.acceration = Math.tuple_plus(point.acceration, self.gravity)
-            
-            point.velocity = Math.tuple_plus(point.velocity, Math.tuple_multiple(point.acceration, delta_time))
-            point.position = Math.tuple_plus(point.position, Math.tuple_multiple(point.velocity, delta_time))
-        #     pygame.draw.line(
-        #         window.surface, Color.WHITE,
-        #         connection.first_node.position, connection.second_node.position)
+        self.engine.step(delta_time, self.gravity)
+        self.step_count += 1
+
+    def store_state(self):
+        self.previous_positions = self.engine.positions.copy()
+
+    def get_state(self) -> Optional[Dict[str, np.ndarray]]:
+        state = self.engine.get_state()
+        state["step_count"] = np.array(self.step_count)
+        return state
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        self.engine.set_state(state)
+        self.step_count = int(state["step_count"])
+        self.previous_positions = None
+        self.drawn_step = None
+
+    def is_dirty(self) -> bool:
+        return self.step_count != self.drawn_step or self.previous_positions is not None
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        if self.engine.node_count == 0:
+            return None
+        return Math.bounding_rect(self.engine.positions, 4)
 
     def draw(self, window: ManagedWindow):
-        for i, point in enumerate(self.points):
-            if point.fixed:
-                pygame.draw.circle(window.surface, Color.RED, point.position, radius=3)
-            else:
-                pygame.draw.circle(window.surface, Color.WHITE, point.position, radius=3)
-            point.acceration = (0, 0)
-        
-        for connection in self.connections:
-            pygame.draw.line(
-                window.surface, Color.WHITE,
-                connection.first_node.position, connection.second_node.position)
+        self.drawn_step = self.step_count
+        positions = window.interpolate_array(self.previous_positions, self.engine.positions)
+        fixed = self.engine.fixed
 
+        draw_circles(window.surface, positions[~fixed], Color.WHITE, 3)
+        draw_circles(window.surface, positions[fixed], Color.RED, 3)
 
-if __name__ == "__main__":
-    window = ManagedWindow((300, 300), step_update=False, tick=30)
+        connections = self.engine.connections
+        draw_segments(window.surface, positions[connections[:, 0]], positions[connections[:, 1]],
+                      map_color(window.surface, Color.WHITE))
 
-    window.children.append(Cloth())
 
-    window.run()
+if __name__ == "__main__":
+    headless = "--headless" in sys.argv
+    window = ManagedWindow((300, 300), step_update=False, tick=30, headless=headless)
+
+    if "--verlet" in sys.argv:
+        cloth = Cloth(solver=ClothEngine.VERLET)
+    else:
+        cloth = Cloth()
+    cloth.engine.self_collision = "--self-collision" in sys.argv
+    if "--tear" in sys.argv:
+        cloth.engine.tear_ratio = cloth.engine.flexable_max * 2
+
+    if "--obstacles" in sys.argv:
+        # Obstacles go in front of the cloth so it collides with where they were dragged this step
+        circle = CircleObstacle((140, 170), radius=20, color=Color.GREEN)
+        rect = RectObstacle((200, 240), size=(80, 16), color=Color.GREEN)
+        window.children.extend((circle, rect))
+        cloth.add_obstacle(circle)
+        cloth.add_obstacle(rect)
+
+    window.children.append(cloth)
+
+    if "--record" in sys.argv:
+        # Keeps the last frames in memory and streams them to recording/session_* for window.seek / replay
+        window.enable_recorder(path="recording")
+
+    if headless:
+        window.run_headless(steps=1000)
+    else:
+        window.run()
@@ -0,0 +1,95 @@
+import pygame
+import numpy as np
+
+from typing import Dict, Set
+
+
+class DebugDraw:
+    # Debug shapes recorded during update and drawn by the window in one pass over the children.
+    # Class level like InputSystem, so any entity can record without holding the window. Only
+    # enabled channels record, hot loops check `enabled` once and skip everything else
+    LINE = 0
+    DOT = 1
+
+    enabled_channels: Set[str] = set()
+    channel_keys: Dict[int, str] = {}
+
+    # Grown when full and then reused, `count` is rewound every physics step
+    count = 0
+    kinds = np.zeros(1024, dtype=np.int8)
+    coordinates = np.zeros((1024, 4))
+    colors = np.zeros((1024, 3), dtype=np.uint8)
+
+    dot_radius = 3
+
+    @classmethod
+    def add_channel(cls, name: str, key: int=None) -> str:
+        if key is not None:
+            cls.channel_keys[key] = name
+        return name
+
+    @classmethod
+    def enabled(cls, channel: str) -> bool:
+        return channel in cls.enabled_channels
+
+    @classmethod
+    def toggle(cls, channel: str):
+        if channel in cls.enabled_channels:
+            cls.enabled_channels.discard(channel)
+        else:
+            cls.enabled_channels.add(channel)
+
+    @classmethod
+    def reserve(cls, amount: int) -> int:
+        # Index of the first of `amount` new shapes, the buffers double when they would not fit
+        start = cls.count
+        size = len(cls.kinds)
+        while size < start + amount:
+            size *= 2
+
+        if size != len(cls.kinds):
+            cls.kinds = np.resize(cls.kinds, size)
+            cls.coordinates = np.resize(cls.coordinates, (size, 4))
+            cls.colors = np.resize(cls.colors, (size, 3))
+
+        cls.count = start + amount
+        return start
+
+    @classmethod
+    def line(cls, start, end, color):
+        index = cls.reserve(1)
+        cls.kinds[index] = cls.LINE
+        cls.coordinates[index] = (start[0], start[1], end[0], end[1])
+        cls.colors[index] = color
+
+    @classmethod
+    def lines(cls, starts: np.ndarray, ends: np.ndarray, color):
+        # Many segments of one colour at once, straight into the buffer
+        start = cls.reserve(len(starts))
+        end = cls.count
+
+        cls.kinds[start:end] = cls.LINE
+        cls.coordinates[start:end, :2] = starts
+        cls.coordinates[start:end, 2:] = ends
+        cls.colors[start:end] = color
+
+    @classmethod
+    def dot(cls, position, color):
+        index = cls.reserve(1)
+        cls.kinds[index] = cls.DOT
+        cls.coordinates[index] = (position[0], position[1], 0, 0)
+        cls.colors[index] = color
+
+    @classmethod
+    def clear(cls):
+        cls.count = 0
+
+    @classmethod
+    def draw(cls, surface: pygame.Surface):
+        count = cls.count
+        for kind, (x_1, y_1, x_2, y_2), color in zip(
+                cls.kinds[:count].tolist(), cls.coordinates[:count].tolist(), cls.colors[:count].tolist()):
+            if kind == cls.LINE:
+                pygame.draw.line(surface, color, (x_1, y_1), (x_2, y_2))
+            else:
+                pygame.draw.circle(surface, color, (x_1, y_1), cls.dot_radius)
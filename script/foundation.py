@@ -1,8 +1,23 @@
 from os import stat
+import os
+import time
 import pygame
+import numpy as np
 import sys
 
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    from .profiler import FrameProfiler
+    from .recorder import StateRecorder
+    from .debug_draw import DebugDraw
+    from .shape_cache import SHAPES
+except ImportError:
+    from profiler import FrameProfiler
+    from recorder import StateRecorder
+    from debug_draw import DebugDraw
+    from shape_cache import SHAPES
 
 
 class Color:
@@ -71,27 +86,417 @@ class Math:
         magnitude = (vector[0] ** 2 + vector[1] ** 2) ** 0.5
         return (vector[0] / magnitude, vector[1] / magnitude)
 
+    @staticmethod
+    def bounding_rect(points, margin: float=0) -> pygame.Rect:
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        left, top = np.floor(points.min(axis=0) - margin)
+        right, bottom = np.ceil(points.max(axis=0) + margin)
+        return pygame.Rect(int(left), int(top), int(right - left) + 1, int(bottom - top) + 1)
+
+    @staticmethod
+    def grow_array(array: np.ndarray, size: int) -> np.ndarray:
+        # Double the first axis until `size` fits, keeping the existing content
+        if size <= len(array):
+            return array
+
+        capacity = max(len(array), 1)
+        while capacity < size:
+            capacity *= 2
+
+        new_array = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+        new_array[:len(array)] = array
+        return new_array
+
+
+class Vec2:
+    # Mutable vector for hot loops. The in-place operators and the set_* / *_ip methods write
+    # into the vector and return it, so a step can reuse the same few vectors without allocating.
+    # It is a sequence of two floats as well, pygame draw calls take it directly
+    __slots__ = ("x", "y")
+
+    def __init__(self, x: float=0.0, y: float=0.0):
+        self.x = x
+        self.y = y
+
+    def __len__(self) -> int:
+        return 2
+
+    def __getitem__(self, index: int) -> float:
+        if index == 0:
+            return self.x
+        if index == 1:
+            return self.y
+        raise IndexError(index)
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+
+    def __eq__(self, other) -> bool:
+        # Anything that is not a pair, None included, is left to Python's default comparison
+        try:
+            if len(other) != 2:
+                return NotImplemented
+            other_x, other_y = other[0], other[1]
+        except (TypeError, KeyError):
+            return NotImplemented
+        return self.x == other_x and self.y == other_y
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return "Vec2(%r, %r)" % (self.x, self.y)
+
+    def as_tuple(self) -> Vector:
+        return (self.x, self.y)
+
+    def copy(self) -> "Vec2":
+        return Vec2(self.x, self.y)
+
+    def set(self, x: float, y: float) -> "Vec2":
+        self.x = x
+        self.y = y
+        return self
+
+    def copy_from(self, other: "Vec2") -> "Vec2":
+        self.x = other.x
+        self.y = other.y
+        return self
+
+    def __iadd__(self, other: "Vec2") -> "Vec2":
+        self.x += other.x
+        self.y += other.y
+        return self
+
+    def __isub__(self, other: "Vec2") -> "Vec2":
+        self.x -= other.x
+        self.y -= other.y
+        return self
+
+    def __imul__(self, scale: float) -> "Vec2":
+        self.x *= scale
+        self.y *= scale
+        return self
+
+    def add_xy(self, x: float, y: float) -> "Vec2":
+        self.x += x
+        self.y += y
+        return self
+
+    def axpy(self, scale: float, other: "Vec2") -> "Vec2":
+        # self += scale * other
+        self.x += scale * other.x
+        self.y += scale * other.y
+        return self
+
+    def set_difference(self, point_a: "Vec2", point_b: "Vec2") -> "Vec2":
+        self.x = point_a.x - point_b.x
+        self.y = point_a.y - point_b.y
+        return self
+
+    def set_lerp(self, point_a: Vector, point_b: Vector, percentage: float) -> "Vec2":
+        # Takes any pair of 2 item sequences, same formula as Math.lerp_point
+        self.x = (point_b[0] - point_a[0]) * percentage + point_a[0]
+        self.y = (point_b[1] - point_a[1]) * percentage + point_a[1]
+        return self
+
+    def sqr_magnitude(self) -> float:
+        return self.x * self.x + self.y * self.y
+
+    def magnitude(self) -> float:
+        return (self.x ** 2 + self.y ** 2) ** 0.5
+
+    def normalize_ip(self) -> "Vec2":
+        magnitude = (self.x ** 2 + self.y ** 2) ** 0.5
+        self.x /= magnitude
+        self.y /= magnitude
+        return self
+
+    def clamp_magnitude_ip(self, clamp_distance: float, clamp_when_distance_over: bool=False) -> "Vec2":
+        # Same rule as Math.clamp_magnitude
+        distance = (self.x ** 2 + self.y ** 2) ** 0.5
+
+        if clamp_when_distance_over and distance < clamp_distance:
+            return self
+
+        magnitude_multiplier = distance / clamp_distance
+        self.x /= magnitude_multiplier
+        self.y /= magnitude_multiplier
+        return self
+
 
 class InputSystem:
+    # Keys only exist in `key_map`, everything else asks about actions. `pressed` and `released`
+    # are edges that belong to the first step that sees them, `held` lasts until the key goes up.
+    # Entities compare the versions with the last ones they handled and skip their input work
+    # when nothing changed, the window reacts to its own actions through `subscribe`
+    LEFT = "left"
+    RIGHT = "right"
+    UP = "up"
+    DOWN = "down"
+    FORWARD = "forward"
+    BACK = "back"
+
+    STEP = "step"
+    STEP_UPDATE = "step_update"
+    PROFILER = "profiler"
+    TRACE = "trace"
+
+    # Recorded with every snapshot, in this order
+    ACTIONS = (LEFT, RIGHT, UP, DOWN, FORWARD, BACK)
+
+    key_map: Dict[int, str] = {
+        pygame.K_a: LEFT,
+        pygame.K_d: RIGHT,
+        pygame.K_e: UP,
+        pygame.K_q: DOWN,
+        pygame.K_w: FORWARD,
+        pygame.K_s: BACK,
+        pygame.K_SPACE: STEP,
+        pygame.K_RETURN: STEP_UPDATE,
+        pygame.K_F3: PROFILER,
+        pygame.K_F4: TRACE,
+    }
+
+    held: Set[str] = set()
+    pressed: Set[str] = set()
+    released: Set[str] = set()
+    subscribers: Dict[str, List[Callable[[str, bool], None]]] = {}
+    action_version = 0
+
     MOUSE_DOWN = False
     MOUSE_UP = False
     MOUSE_POS = (0, 0)
+    mouse_version = 0
+
+    EVENT_HANDLERS: Dict[int, Callable[[pygame.event.Event], None]] = {
+        pygame.KEYDOWN: lambda event: InputSystem.key_down(event.key),
+        pygame.KEYUP: lambda event: InputSystem.key_up(event.key),
+        pygame.MOUSEBUTTONDOWN: lambda event: InputSystem.mouse_down(),
+        pygame.MOUSEBUTTONUP: lambda event: InputSystem.mouse_up(),
+        pygame.MOUSEMOTION: lambda event: InputSystem.move_mouse(event.pos),
+    }
+
+    @classmethod
+    def bind(cls, key: int, action: str):
+        cls.key_map[key] = action
+
+    @classmethod
+    def subscribe(cls, action: str, callback: Callable[[str, bool], None]):
+        # `callback(action, pressed)` runs on the main thread as soon as the action changes
+        cls.subscribers.setdefault(action, []).append(callback)
+
+    @classmethod
+    def unsubscribe(cls, action: str, callback: Callable[[str, bool], None]):
+        callbacks = cls.subscribers.get(action)
+        if callbacks is not None and callback in callbacks:
+            callbacks.remove(callback)
+
+    @classmethod
+    def is_held(cls, action: str) -> bool:
+        return action in cls.held
+
+    @classmethod
+    def was_pressed(cls, action: str) -> bool:
+        return action in cls.pressed
+
+    @classmethod
+    def was_released(cls, action: str) -> bool:
+        return action in cls.released
+
+    @classmethod
+    def press(cls, action: str):
+        if action in cls.held:
+            return
+        cls.held.add(action)
+        cls.pressed.add(action)
+        cls.action_version += 1
+
+        for callback in cls.subscribers.get(action, ()):
+            callback(action, True)
+
+    @classmethod
+    def release(cls, action: str):
+        if action not in cls.held:
+            return
+        cls.held.discard(action)
+        cls.released.add(action)
+        cls.action_version += 1
+
+        for callback in cls.subscribers.get(action, ()):
+            callback(action, False)
+
+    @classmethod
+    def key_down(cls, key: int):
+        action = cls.key_map.get(key)
+        if action is not None:
+            cls.press(action)
+
+    @classmethod
+    def key_up(cls, key: int):
+        action = cls.key_map.get(key)
+        if action is not None:
+            cls.release(action)
+
+    @classmethod
+    def mouse_down(cls):
+        cls.MOUSE_DOWN = True
+        cls.mouse_version += 1
+
+    @classmethod
+    def mouse_up(cls):
+        cls.MOUSE_UP = True
+        cls.mouse_version += 1
+
+    @classmethod
+    def move_mouse(cls, position: Vector):
+        if position != cls.MOUSE_POS:
+            cls.MOUSE_POS = position
+            cls.mouse_version += 1
+
+    @classmethod
+    def handle_event(cls, event: pygame.event.Event):
+        handler = cls.EVENT_HANDLERS.get(event.type)
+        if handler is not None:
+            handler(event)
+
+    @classmethod
+    def end_step(cls):
+        # An edge going away is a change too, whoever skipped on the version looks again next step
+        if cls.pressed or cls.released:
+            cls.pressed.clear()
+            cls.released.clear()
+            cls.action_version += 1
+
+        if cls.MOUSE_DOWN or cls.MOUSE_UP:
+            cls.MOUSE_DOWN = False
+            cls.MOUSE_UP = False
+            cls.mouse_version += 1
+
+    @classmethod
+    def get_state(cls) -> np.ndarray:
+        return np.array((cls.MOUSE_DOWN, cls.MOUSE_UP, *cls.MOUSE_POS,
+                         *(action in cls.held for action in cls.ACTIONS)), dtype=float)
+
+    @classmethod
+    def set_state(cls, state: np.ndarray):
+        # Only the recorded actions are touched, and only the ones that differ go through
+        # press / release, so subscribers see a replay like live input
+        state = state.tolist()
+        cls.MOUSE_DOWN = bool(state[0])
+        cls.MOUSE_UP = bool(state[1])
+        cls.MOUSE_POS = (state[2], state[3])
+        cls.mouse_version += 1
+
+        for action, value in zip(cls.ACTIONS, state[4:]):
+            if value:
+                cls.press(action)
+            else:
+                cls.release(action)
+
+
+
+class InputTimeline:
+    # Scripted input for headless runs, events are applied right before the step they are keyed on
+    # and go through the same InputSystem calls as the real devices
+    MOUSE_POS = "mouse_pos"
+    MOUSE_DOWN = "mouse_down"
+    MOUSE_UP = "mouse_up"
+    KEY_DOWN = "key_down"
+    KEY_UP = "key_up"
+    PRESS = "press"
+    RELEASE = "release"
+
+    HANDLERS: Dict[str, Callable[[object], None]] = {
+        MOUSE_POS: lambda value: InputSystem.move_mouse(value),
+        MOUSE_DOWN: lambda value: InputSystem.mouse_down(),
+        MOUSE_UP: lambda value: InputSystem.mouse_up(),
+        KEY_DOWN: lambda value: InputSystem.key_down(InputTimeline.key_code(value)),
+        KEY_UP: lambda value: InputSystem.key_up(InputTimeline.key_code(value)),
+        PRESS: lambda value: InputSystem.press(value),
+        RELEASE: lambda value: InputSystem.release(value),
+    }
+
+    def __init__(self):
+        self.events: Dict[int, List[Tuple[str, object]]] = {}
+
+    def add(self, step: int, kind: str, value=None) -> "InputTimeline":
+        self.events.setdefault(step, []).append((kind, value))
+        return self
+
+    def mouse_move(self, step: int, position: Vector) -> "InputTimeline":
+        return self.add(step, self.MOUSE_POS, position)
+
+    def mouse_down(self, step: int) -> "InputTimeline":
+        return self.add(step, self.MOUSE_DOWN)
+
+    def mouse_up(self, step: int) -> "InputTimeline":
+        return self.add(step, self.MOUSE_UP)
+
+    def key_down(self, step: int, key) -> "InputTimeline":
+        # `key` is a pygame key code or a key name such as "a" or "space"
+        return self.add(step, self.KEY_DOWN, key)
+
+    def key_up(self, step: int, key) -> "InputTimeline":
+        return self.add(step, self.KEY_UP, key)
+
+    def press(self, step: int, action: str) -> "InputTimeline":
+        return self.add(step, self.PRESS, action)
+
+    def release(self, step: int, action: str) -> "InputTimeline":
+        return self.add(step, self.RELEASE, action)
+
+    def drag(self, start_step: int, end_step: int, start_position: Vector, end_position: Vector) -> "InputTimeline":
+        self.mouse_move(start_step, start_position)
+        self.mouse_down(start_step)
+
+        for step in range(start_step + 1, end_step + 1):
+            percentage = (step - start_step) / (end_step - start_step)
+            self.mouse_move(step, Math.lerp_point(start_position, end_position, percentage))
+
+        return self.mouse_up(end_step)
+
+    @staticmethod
+    def key_code(key) -> int:
+        return pygame.key.key_code(key) if isinstance(key, str) else key
 
-    KEY_A = False
-    KEY_D = False
-    KEY_E = False
-    KEY_Q = False
-    KEY_S = False
-    KEY_W = False
+    def apply(self, step: int):
+        for kind, value in self.events.get(step, ()):
+            self.HANDLERS[kind](value)
 
 
 class Entity:
+    # An independent entity only touches its own state in update, so the window may step it
+    # on a worker thread alongside others. Worth it for array backed engines, numpy lets go
+    # of the GIL inside its loops while plain python entities would just take turns
+    independent = False
+
     def update(self,  delta_time: float):
         raise NotImplementedError("Draw function not implemented")
 
     def draw(self, window: "ManagedWindow"):
         raise NotImplementedError("Draw function not implemented")
 
+    def store_state(self):
+        # Called before every physics step when the window interpolates, keep what draw needs to blend from
+        pass
+
+    # Used by the window's dirty rect mode, an entity that does not know its bounds
+    # (None) is treated as covering the whole window and is redrawn every frame
+    def is_dirty(self) -> bool:
+        return True
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        return None
+
+    # Snapshot of everything update depends on, as named arrays, for the window's recorder.
+    # None leaves the entity out of recordings
+    def get_state(self) -> Optional[Dict[str, np.ndarray]]:
+        return None
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        pass
+
 
 class Point(Entity):
     def __init__(self, position, color=None, radius=3, width=2):
@@ -105,14 +510,36 @@ class Point(Entity):
         self.radius = radius
         self.width = width
 
+        self.drawn_state = None
+
     def update(self, delta_time: float):
         pass
 
+    def draw_state(self):
+        return (tuple(self.position), self.color, self.radius, self.width)
+
+    def is_dirty(self) -> bool:
+        return self.draw_state() != self.drawn_state
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        return Math.bounding_rect(self.position, self.radius + 1)
+
+    def get_state(self) -> Optional[Dict[str, np.ndarray]]:
+        return {"position": np.array(self.position, dtype=float)}
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        self.position = tuple(state["position"].tolist())
+
+    def blit_circle(self, window: "ManagedWindow", color):
+        SHAPES.draw_circle(window.surface, color, self.position, self.radius, self.width)
+
     def draw(self, window: "ManagedWindow"):
-        pygame.draw.circle(window.surface, self.color, self.position, self.radius, self.width)
+        self.blit_circle(window, self.color)
+        self.drawn_state = self.draw_state()
 
 class ManagedWindow:
-    def __init__(self, size: Vector, step_update=False, tick=30) -> None:
+    def __init__(self, size: Vector, step_update=False, tick=30, physics_rate=30, max_substeps=5,
+                 interpolate=False, headless=False, dirty_rects=False, workers=0) -> None:
         self.size = size
         self.full_rect = (0, 0, *size)
         self.surface: pygame.Surface = None
@@ -122,77 +549,390 @@ class ManagedWindow:
 
         self.step_update = step_update
 
+        # `tick` caps the render rate, physics always advances in steps of 1 / physics_rate
         self.tick = tick
+        self.physics_rate = physics_rate
+        self.max_substeps = max_substeps
+        self.interpolate = interpolate
+        self.interpolation_alpha = 1
+
+        self.accumulator = 0
+        self.step_index = 0
+
+        # With more than one worker, independent children are updated on a thread pool
+        self.workers = workers
+        self.executor: ThreadPoolExecutor = None
+
+        # Created on first use, see enable_profiler and the PROFILER / TRACE actions
+        self.profiler: FrameProfiler = None
+        self.recorder: StateRecorder = None
+        self.overlay_rect: pygame.Rect = None
+
+        # Only clear and push the regions entities report as changed, instead of the whole window
+        self.dirty_rects = dirty_rects
+        self.drawn_rects: Dict[Entity, pygame.Rect] = None
+        self.debug_drawn = False
+
+        # Window actions by name, subscribed to InputSystem while run is going
+        self.window_actions: Dict[str, Callable[[], None]] = {}
+
+        self.headless = headless
+        if headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
 
         pygame.init()
 
+    @property
+    def physics_delta(self) -> float:
+        return 1 / self.physics_rate
+
+    def interpolate_array(self, previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+        if not self.interpolate or previous is None or previous.shape != current.shape:
+            return current
+        return previous + (current - previous) * self.interpolation_alpha
+
+    def enable_profiler(self, trace_path: str=None) -> FrameProfiler:
+        if self.profiler is None:
+            self.profiler = FrameProfiler()
+
+        if trace_path is not None:
+            self.profiler.start_trace(trace_path)
+        return self.profiler
+
+    def enable_recorder(self, capacity=600, path: str=None) -> StateRecorder:
+        if self.recorder is None:
+            self.recorder = StateRecorder(capacity=capacity, path=path)
+        return self.recorder
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        # Child states are keyed by their place in `children`, a replay needs the same children
+        state = {"input": InputSystem.get_state()}
+
+        for index, child in enumerate(self.children):
+            child_state = child.get_state()
+            if child_state is not None:
+                for name, value in child_state.items():
+                    state["%d/%s" % (index, name)] = value
+        return state
+
+    def restore_snapshot(self, state: Dict[str, np.ndarray]):
+        InputSystem.set_state(state["input"])
+
+        child_states: Dict[int, Dict[str, np.ndarray]] = {}
+        for key, value in state.items():
+            if key != "input":
+                index, name = key.split("/", 1)
+                child_states.setdefault(int(index), {})[name] = value
+
+        for index, child_state in child_states.items():
+            self.children[index].set_state(child_state)
+
+    def seek(self, step: int):
+        # Puts every recorded child and the input back to how they were right before `step`
+        self.restore_snapshot(self.recorder.frame(step))
+        self.step_index = step
+
+    def replay(self, start_step: int, end_step: int, draw=False) -> float:
+        # Steps again from a recorded frame feeding only the recorded input, then reports how far
+        # the result drifted from the recorded `end_step`, 0 for a deterministic scene
+        recorder = self.recorder
+        self.seek(start_step)
+        self.recorder = None
+
+        try:
+            for step in range(start_step, end_step):
+                InputSystem.set_state(recorder.frame(step)["input"])
+                self.step_children()
+
+                if draw:
+                    self.draw_children()
+        finally:
+            self.recorder = recorder
+
+        # Input is left out, after a step its click edges are already cleared
+        replayed = {key: value for key, value in self.snapshot().items() if key != "input"}
+        recorded = {key: value for key, value in recorder.frame(end_step).items() if key != "input"}
+        return StateRecorder.divergence(replayed, recorded)
+
+    def timed_update(self, child: Entity) -> Tuple[float, float]:
+        start = time.perf_counter()
+        child.update(self.physics_delta)
+        return start, time.perf_counter()
+
+    def step_independent_children(self, indices: List[int]):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="update")
+
+        futures = [self.executor.submit(self.timed_update, self.children[index]) for index in indices]
+
+        # Gathered before anything else runs, so dependent children and draw see finished steps
+        for index, future in zip(indices, futures):
+            start, end = future.result()
+            if self.profiler is not None:
+                self.profiler.record(index, self.children[index], FrameProfiler.UPDATE, start, end)
+
+    def step_children(self):
+        profiler = self.profiler
+
+        # Recorded after the step's input is in and before anything moves
+        if self.recorder is not None:
+            self.recorder.capture(self.step_index, self.snapshot())
+        self.step_index += 1
+
+        if self.interpolate:
+            for child in self.children:
+                child.store_state()
+
+        # Debug shapes show the latest step only, and are recorded from one thread
+        DebugDraw.clear()
+
+        parallel = self.workers > 1 and not DebugDraw.enabled_channels
+        if parallel:
+            independent_indices = [index for index, child in enumerate(self.children) if child.independent]
+            parallel = len(independent_indices) > 1
+
+        if parallel:
+            self.step_independent_children(independent_indices)
+
+        for index, child in enumerate(self.children):
+            if parallel and child.independent:
+                continue
+
+            if profiler is None:
+                child.update(self.physics_delta)
+            else:
+                start, end = self.timed_update(child)
+                profiler.record(index, child, FrameProfiler.UPDATE, start, end)
+
+        # Clicks and presses are edges, they belong to the first step that sees them
+        InputSystem.end_step()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+        if self.profiler is not None:
+            self.profiler.stop_trace()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+        for action in self.window_actions:
+            InputSystem.unsubscribe(action, self.on_window_action)
+
+    def advance(self, frame_time: float, update_key_pressed=False) -> int:
+        if self.step_update:
+            self.accumulator = 0
+            self.interpolation_alpha = 1
+
+            if update_key_pressed:
+                self.step_children()
+                return 1
+            return 0
+
+        self.accumulator += frame_time
+
+        substeps = 0
+        while self.accumulator >= self.physics_delta and substeps < self.max_substeps:
+            self.step_children()
+            self.accumulator -= self.physics_delta
+            substeps += 1
+
+        # Too far behind, drop the backlog instead of spiralling
+        if substeps == self.max_substeps:
+            self.accumulator = min(self.accumulator, self.physics_delta)
+
+        self.interpolation_alpha = self.accumulator / self.physics_delta if self.interpolate else 1
+        return substeps
+
+    def draw_child(self, index: int, child: Entity):
+        if self.profiler is None:
+            child.draw(self)
+            return
+
+        start = time.perf_counter()
+        child.draw(self)
+        self.profiler.record(index, child, FrameProfiler.DRAW, start, time.perf_counter())
+
+    def draw_overlay(self) -> Optional[pygame.Rect]:
+        if self.profiler is None or not self.profiler.show_overlay:
+            return None
+        return self.profiler.draw_overlay(self.surface)
+
+    def draw_children(self) -> Optional[List[pygame.Rect]]:
+        # Returns the regions that changed, None when the whole surface was redrawn
+        # Debug shapes have no bounds, with a channel on (or just turned off) the whole window is redrawn
+        debug_draw = bool(DebugDraw.enabled_channels)
+        if self.dirty_rects and self.drawn_rects is not None and not debug_draw and not self.debug_drawn:
+            return self.draw_dirty_children()
+
+        pygame.draw.rect(self.surface, self.background_color, self.full_rect)
+
+        for index, child in enumerate(self.children):
+            self.draw_child(index, child)
+
+        if DebugDraw.count:
+            DebugDraw.draw(self.surface)
+        self.debug_drawn = debug_draw
+
+        self.overlay_rect = self.draw_overlay()
+
+        if self.dirty_rects:
+            self.drawn_rects = {child: child.bounding_rect() or pygame.Rect(self.full_rect) for child in self.children}
+        return None
+
+    def draw_dirty_children(self) -> List[pygame.Rect]:
+        full_rect = pygame.Rect(self.full_rect)
+
+        regions: List[pygame.Rect] = []
+        drawn_rects = {}
+        for child in self.children:
+            rect = child.bounding_rect() or full_rect
+            previous_rect = self.drawn_rects.pop(child, None)
+
+            if previous_rect is None or rect != previous_rect or child.is_dirty():
+                regions.append(rect)
+                if previous_rect is not None:
+                    regions.append(previous_rect)
+            drawn_rects[child] = rect
+
+        # Whatever is left belonged to removed children, clear where they were
+        regions.extend(self.drawn_rects.values())
+        self.drawn_rects = drawn_rects
+
+        if self.overlay_rect is not None:
+            regions.append(self.overlay_rect)
+
+        regions = self.merge_regions(regions, full_rect)
+
+        for region in regions:
+            # Everything under a cleared region is redrawn, clipped so the overdraw stays inside it
+            self.surface.set_clip(region)
+            pygame.draw.rect(self.surface, self.background_color, region)
+
+            for index, child in enumerate(self.children):
+                if drawn_rects[child].colliderect(region):
+                    self.draw_child(index, child)
+        self.surface.set_clip(None)
+
+        self.overlay_rect = self.draw_overlay()
+        if self.overlay_rect is not None:
+            regions.append(self.overlay_rect)
+
+        return regions
+
+    @staticmethod
+    def merge_regions(regions: List[pygame.Rect], bounds: pygame.Rect) -> List[pygame.Rect]:
+        merged: List[pygame.Rect] = []
+
+        for region in regions:
+            region = region.clip(bounds)
+            if region.width == 0 or region.height == 0:
+                continue
+
+            # Keep folding overlapping rects in until the region stops growing
+            index = region.collidelist(merged)
+            while index != -1:
+                region.union_ip(merged.pop(index))
+                index = region.collidelist(merged)
+            merged.append(region)
+
+        return merged
+
+    def toggle_trace(self):
+        profiler = self.enable_profiler()
+        if profiler.tracing:
+            profiler.stop_trace()
+        else:
+            profiler.start_trace(time.strftime("trace_%Y%m%d_%H%M%S.json"))
+
+    def toggle_overlay(self):
+        profiler = self.enable_profiler()
+        profiler.show_overlay = not profiler.show_overlay
+
+    def toggle_step_update(self):
+        self.step_update = not self.step_update
+
+    def subscribe_window_actions(self):
+        self.window_actions = {
+            InputSystem.STEP_UPDATE: self.toggle_step_update,
+            InputSystem.PROFILER: self.toggle_overlay,
+            InputSystem.TRACE: self.toggle_trace,
+        }
+
+        # Every debug channel key becomes an action of its own
+        for key, channel in DebugDraw.channel_keys.items():
+            action = "debug/" + channel
+            InputSystem.bind(key, action)
+            self.window_actions[action] = lambda channel=channel: DebugDraw.toggle(channel)
+
+        for action in self.window_actions:
+            InputSystem.subscribe(action, self.on_window_action)
+
+    def on_window_action(self, action: str, pressed: bool):
+        if pressed:
+            self.window_actions[action]()
+
     def run(self):
         self.surface = pygame.display.set_mode(self.size)
+        self.subscribe_window_actions()
 
         clock = pygame.time.Clock()
+        frame_time = 0
 
         while True:
-            InputSystem.MOUSE_DOWN = False
-            InputSystem.MOUSE_UP = False
-            update_key_pressed = False
+            if self.profiler is not None:
+                self.profiler.begin_frame()
 
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
+                    self.close()
                     pygame.quit()
                     return
 
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    InputSystem.MOUSE_DOWN = True
-
-                elif event.type == pygame.MOUSEBUTTONUP:
-                    InputSystem.MOUSE_UP = True
-
-                elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_a:
-                        InputSystem.KEY_A = True
-                    elif event.key == pygame.K_d:
-                        InputSystem.KEY_D = True
-                    elif event.key == pygame.K_e:
-                        InputSystem.KEY_E = True
-                    elif event.key == pygame.K_q:
-                        InputSystem.KEY_Q = True
-                    elif event.key == pygame.K_s:
-                        InputSystem.KEY_S = True
-                    elif event.key == pygame.K_w:
-                        InputSystem.KEY_W = True
-
-                    elif event.key == pygame.K_SPACE:
-                        update_key_pressed = True
-                    elif event.key == pygame.K_RETURN:
-                        self.step_update = not self.step_update
-
-                elif event.type == pygame.KEYUP:
-                    if event.key == pygame.K_a:
-                        InputSystem.KEY_A = False
-                    elif event.key == pygame.K_d:
-                        InputSystem.KEY_D = False
-                    elif event.key == pygame.K_e:
-                        InputSystem.KEY_E = False
-                    elif event.key == pygame.K_q:
-                        InputSystem.KEY_Q = False
-                    elif event.key == pygame.K_s:
-                        InputSystem.KEY_S = False
-                    elif event.key == pygame.K_w:
-                        InputSystem.KEY_W = False
-
-            InputSystem.MOUSE_POS = pygame.mouse.get_pos()
-            
-            pygame.draw.rect(self.surface, self.background_color, self.full_rect)
+                InputSystem.handle_event(event)
 
-            for child in self.children:
-                if self.step_update:
-                    if update_key_pressed:
-                        child.update(1 / 30)
-                else:
-                    child.update(1 / 30)
+            InputSystem.move_mouse(pygame.mouse.get_pos())
+
+            substeps = self.advance(frame_time, InputSystem.was_pressed(InputSystem.STEP))
+            dirty_regions = self.draw_children()
+
+            if dirty_regions is None:
+                pygame.display.flip()
+            elif dirty_regions:
+                pygame.display.update(dirty_regions)
+
+            if self.profiler is not None:
+                self.profiler.end_frame(substeps)
+
+            frame_time = clock.tick(self.tick) / 1000
+
+    def run_headless(self, steps: int, timeline: InputTimeline=None, draw=True) -> float:
+        # No display and no frame cap, draw goes to an off-screen surface or is skipped
+        self.surface = pygame.Surface(self.size)
+
+        start_time = time.perf_counter()
+
+        for step in range(steps):
+            if self.profiler is not None:
+                self.profiler.begin_frame()
+
+            if timeline is not None:
+                timeline.apply(step)
+
+            self.step_children()
+
+            if draw:
+                self.draw_children()
+
+            if self.profiler is not None:
+                self.profiler.end_frame(1)
 
-                child.draw(self)
+        self.close()
 
-            pygame.display.flip()
-            clock.tick(self.tick)
+        elapsed_time = time.perf_counter() - start_time
+        steps_per_second = steps / elapsed_time if elapsed_time > 0 else float("inf")
 
+        print("%d steps in %.3fs, %.1f steps/s" % (steps, elapsed_time, steps_per_second))
+        return steps_per_second
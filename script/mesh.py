@@ -0,0 +1,24 @@
+import numpy as np
+
+from typing import Tuple
+
+
+class Mesh:
+    # Shape data shared by every instance, vertices in local space, edges as vertex index pairs
+    # and optional triangles. Arrays are kept as given, so memory-mapped buffers are not copied
+    def __init__(self, vertices, lines, faces=None, bounding_sphere: Tuple[np.ndarray, float]=None):
+        self.vertices = vertices if isinstance(vertices, np.ndarray) else np.array(vertices, dtype=float).reshape(-1, 3)
+        self.lines = lines if isinstance(lines, np.ndarray) else np.array(lines, dtype=np.intp).reshape(-1, 2)
+
+        if faces is None:
+            faces = np.zeros((0, 3), dtype=np.intp)
+        self.faces = faces if isinstance(faces, np.ndarray) else np.array(faces, dtype=np.intp).reshape(-1, 3)
+
+        if bounding_sphere is not None:
+            self.bounding_center, self.bounding_radius = np.asarray(bounding_sphere[0], dtype=float), bounding_sphere[1]
+        elif len(self.vertices):
+            self.bounding_center = (self.vertices.min(axis=0) + self.vertices.max(axis=0)) / 2
+            self.bounding_radius = float(np.linalg.norm(self.vertices - self.bounding_center, axis=1).max())
+        else:
+            self.bounding_center = np.zeros(3)
+            self.bounding_radius = 0
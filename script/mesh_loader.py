@@ -0,0 +1,140 @@
+import os
+import struct
+import numpy as np
+
+from typing import List, Tuple
+
+try:
+    from .mesh import Mesh
+except ImportError:
+    from mesh import Mesh
+
+
+# Cache layout: fixed size header, then float32 vertices (n, 3), int32 lines (n, 2) and int32 faces (n, 3).
+# The header records the source file size and mtime so a stale cache is rebuilt instead of loaded
+CACHE_MAGIC = b"PGMESH01"
+CACHE_HEADER = struct.Struct("<8sQQQQq4d")
+CACHE_HEADER_SIZE = 128
+CACHE_SUFFIX = ".meshcache"
+
+
+def parse_index(token: str, vertex_count: int) -> int:
+    # "7", "7/2", "7//3" or "-1", OBJ indices start at 1 and negative ones count from the end
+    index = int(token.split("/", 1)[0])
+    return index - 1 if index > 0 else vertex_count + index
+
+
+def parse_obj(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    vertices: List[Tuple[float, float, float]] = []
+    edges: List[Tuple[int, int]] = []
+    faces: List[Tuple[int, int, int]] = []
+
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("v "):
+                x, y, z = line.split()[1:4]
+                vertices.append((float(x), float(y), float(z)))
+
+            elif line.startswith("f ") or line.startswith("l "):
+                indices = [parse_index(token, len(vertices)) for token in line.split()[1:]]
+                edges.extend(zip(indices, indices[1:]))
+
+                if line[0] == "f" and len(indices) >= 3:
+                    # Close the polygon and fan triangulate it for solid rendering
+                    edges.append((indices[-1], indices[0]))
+                    faces.extend((indices[0], indices[i], indices[i + 1]) for i in range(1, len(indices) - 1))
+
+    vertices = np.array(vertices, dtype=np.float32).reshape(-1, 3)
+    faces = np.array(faces, dtype=np.int32).reshape(-1, 3)
+    return vertices, deduplicate_edges(np.array(edges, dtype=np.int64).reshape(-1, 2), len(vertices)), faces
+
+
+def deduplicate_edges(edges: np.ndarray, vertex_count: int) -> np.ndarray:
+    # Neighbouring faces share their edges, fold (a, b) and (b, a) into one key and keep each key once
+    first = np.minimum(edges[:, 0], edges[:, 1])
+    second = np.maximum(edges[:, 0], edges[:, 1])
+    keys = np.unique(first[first != second] * vertex_count + second[first != second])
+    return np.stack((keys // max(vertex_count, 1), keys % max(vertex_count, 1)), axis=1).astype(np.int32)
+
+
+def bounding_sphere(vertices: np.ndarray) -> Tuple[np.ndarray, float]:
+    if len(vertices) == 0:
+        return np.zeros(3), 0
+    center = (vertices.min(axis=0).astype(float) + vertices.max(axis=0)) / 2
+    return center, float(np.linalg.norm(vertices - center, axis=1).max())
+
+
+def write_cache(cache_path: str, source_stat: os.stat_result, vertices: np.ndarray, lines: np.ndarray, faces: np.ndarray):
+    center, radius = bounding_sphere(vertices)
+    header = CACHE_HEADER.pack(
+        CACHE_MAGIC, len(vertices), len(lines), len(faces),
+        source_stat.st_size, source_stat.st_mtime_ns, *center, radius)
+
+    # Written next to the final name and swapped in, a crash never leaves half a cache behind
+    temporary_path = cache_path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(header.ljust(CACHE_HEADER_SIZE, b"\0"))
+        f.write(np.ascontiguousarray(vertices, dtype=np.float32).tobytes())
+        f.write(np.ascontiguousarray(lines, dtype=np.int32).tobytes())
+        f.write(np.ascontiguousarray(faces, dtype=np.int32).tobytes())
+    os.replace(temporary_path, cache_path)
+
+
+def read_cache(cache_path: str, source_stat: os.stat_result) -> Mesh:
+    # Returns None when the cache is missing, broken or older than the source
+    try:
+        with open(cache_path, "rb") as f:
+            header = f.read(CACHE_HEADER.size)
+    except OSError:
+        return None
+
+    if len(header) != CACHE_HEADER.size:
+        return None
+
+    magic, vertex_count, line_count, face_count, source_size, source_mtime, *sphere = CACHE_HEADER.unpack(header)
+    if magic != CACHE_MAGIC or source_size != source_stat.st_size or source_mtime != source_stat.st_mtime_ns:
+        return None
+
+    offset = CACHE_HEADER_SIZE
+    expected_size = offset + vertex_count * 12 + line_count * 8 + face_count * 12
+    if os.path.getsize(cache_path) != expected_size:
+        return None
+
+    def mapped(dtype, count: int, width: int) -> np.ndarray:
+        nonlocal offset
+        if count == 0:
+            return np.zeros((0, width), dtype=dtype)
+
+        array = np.memmap(cache_path, dtype=dtype, mode="r", offset=offset, shape=(count, width))
+        offset += array.nbytes
+        return array
+
+    vertices = mapped(np.float32, vertex_count, 3)
+    lines = mapped(np.int32, line_count, 2)
+    faces = mapped(np.int32, face_count, 3)
+    return Mesh(vertices, lines, faces=faces, bounding_sphere=(np.array(sphere[:3]), sphere[3]))
+
+
+def load_obj(path: str, use_cache=True) -> Mesh:
+    source_stat = os.stat(path)
+    cache_path = path + CACHE_SUFFIX
+
+    if use_cache:
+        mesh = read_cache(cache_path, source_stat)
+        if mesh is not None:
+            return mesh
+
+    vertices, lines, faces = parse_obj(path)
+
+    if use_cache:
+        try:
+            write_cache(cache_path, source_stat, vertices, lines, faces)
+        except OSError:
+            pass
+        else:
+            # Mapped back from the file just written, unless it was replaced or changed in between
+            mesh = read_cache(cache_path, source_stat)
+            if mesh is not None:
+                return mesh
+
+    return Mesh(vertices, lines, faces=faces)
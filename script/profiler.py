@@ -0,0 +1,165 @@
+import json
+import time
+import pygame
+import numpy as np
+
+from collections import deque
+from typing import Deque, Dict, List
+
+
+class EntityStats:
+    def __init__(self, label: str, window_size: int):
+        self.label = label
+        self.update_samples: Deque[float] = deque(maxlen=window_size)
+        self.draw_samples: Deque[float] = deque(maxlen=window_size)
+
+        # Cost of the frame being measured, an entity can update several times per frame
+        self.frame_update = 0
+        self.frame_draw = 0
+
+    def mean_cost(self) -> float:
+        update_mean = sum(self.update_samples) / len(self.update_samples) if self.update_samples else 0
+        draw_mean = sum(self.draw_samples) / len(self.draw_samples) if self.draw_samples else 0
+        return update_mean + draw_mean
+
+
+class FrameProfiler:
+    # Bucket edges in milliseconds for the rolling histograms
+    HISTOGRAM_BUCKETS = (0, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 33, 66, float("inf"))
+
+    UPDATE = "update"
+    DRAW = "draw"
+
+    def __init__(self, window_size=120, top_count=5):
+        self.window_size = window_size
+        self.top_count = top_count
+
+        self.entities: Dict[int, EntityStats] = {}
+        self.frame_times: Deque[float] = deque(maxlen=window_size)
+        self.frame_index = 0
+        # The profiler can be created halfway through a frame, so start timing from here.
+        # frame_times holds begin to begin, the frame cap's sleep included, or the FPS would
+        # only count the work
+        self.frame_start = time.perf_counter()
+        self.previous_begin: float = None
+
+        self.show_overlay = False
+        self.font: pygame.font.Font = None
+
+        self.origin = time.perf_counter()
+        self.trace_file = None
+        self.trace_events: List[Dict] = []
+
+    def stats_for(self, index: int, entity) -> EntityStats:
+        stats = self.entities.get(index)
+        if stats is None or not stats.label.startswith(type(entity).__name__ + "["):
+            stats = EntityStats("%s[%d]" % (type(entity).__name__, index), self.window_size)
+            self.entities[index] = stats
+        return stats
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+        if self.previous_begin is not None:
+            self.frame_times.append(self.frame_start - self.previous_begin)
+        self.previous_begin = self.frame_start
+
+    def record(self, index: int, entity, phase: str, start: float, end: float):
+        stats = self.stats_for(index, entity)
+        if phase == self.UPDATE:
+            stats.frame_update += end - start
+        else:
+            stats.frame_draw += end - start
+
+        if self.trace_file is not None:
+            self.trace_events.append(self.trace_event("%s.%s" % (stats.label, phase), phase, start, end))
+
+    def end_frame(self, substeps=0):
+        end = time.perf_counter()
+
+        for stats in self.entities.values():
+            stats.update_samples.append(stats.frame_update)
+            stats.draw_samples.append(stats.frame_draw)
+            stats.frame_update = 0
+            stats.frame_draw = 0
+
+        if self.trace_file is not None:
+            frame_event = self.trace_event("frame", "frame", self.frame_start, end)
+            frame_event["args"] = {"frame": self.frame_index, "substeps": substeps}
+            self.trace_events.insert(0, frame_event)
+            self.flush_trace()
+
+        self.frame_index += 1
+
+    def fps(self) -> float:
+        total = sum(self.frame_times)
+        return len(self.frame_times) / total if total > 0 else 0
+
+    def frame_time_percentile(self, percentile: float) -> float:
+        if not self.frame_times:
+            return 0
+        return float(np.percentile(self.frame_times, percentile))
+
+    def histogram(self, index: int, phase: str) -> List[int]:
+        stats = self.entities[index]
+        samples = stats.update_samples if phase == self.UPDATE else stats.draw_samples
+        counts, _ = np.histogram(np.array(samples) * 1000, bins=self.HISTOGRAM_BUCKETS)
+        return counts.tolist()
+
+    def top_entities(self) -> List[EntityStats]:
+        return sorted(self.entities.values(), key=EntityStats.mean_cost, reverse=True)[:self.top_count]
+
+    def overlay_lines(self) -> List[str]:
+        lines = ["FPS %.1f  frame %.2fms  p95 %.2fms" % (
+            self.fps(), self.frame_time_percentile(50) * 1000, self.frame_time_percentile(95) * 1000)]
+
+        for stats in self.top_entities():
+            update_mean = sum(stats.update_samples) / max(len(stats.update_samples), 1)
+            draw_mean = sum(stats.draw_samples) / max(len(stats.draw_samples), 1)
+            lines.append("%-16s update %.2fms  draw %.2fms" % (stats.label, update_mean * 1000, draw_mean * 1000))
+
+        return lines
+
+    def draw_overlay(self, surface: pygame.Surface) -> pygame.Rect:
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+
+        overlay_rect = pygame.Rect(4, 4, 0, 0)
+        for line in self.overlay_lines():
+            text = self.font.render(line, True, (255, 255, 0), (0, 0, 0))
+            overlay_rect.union_ip(surface.blit(text, (4, overlay_rect.bottom)))
+        return overlay_rect
+
+    def trace_event(self, name: str, category: str, start: float, end: float) -> Dict:
+        # Chrome trace "complete" event, timestamps are microseconds
+        return {
+            "name": name, "cat": category, "ph": "X", "pid": 1, "tid": 1,
+            "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+        }
+
+    def start_trace(self, path: str):
+        self.stop_trace()
+
+        # Streamed as a JSON array, frames are written as they finish so long sessions stay out of memory
+        self.trace_file = open(path, "w")
+        self.trace_file.write("[\n")
+        self.trace_file.write(json.dumps({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "ManagedWindow"}}))
+        self.trace_events.clear()
+
+    def flush_trace(self):
+        for event in self.trace_events:
+            self.trace_file.write(",\n")
+            self.trace_file.write(json.dumps(event))
+        self.trace_events.clear()
+
+    def stop_trace(self):
+        if self.trace_file is None:
+            return
+
+        self.flush_trace()
+        self.trace_file.write("\n]\n")
+        self.trace_file.close()
+        self.trace_file = None
+
+    @property
+    def tracing(self) -> bool:
+        return self.trace_file is not None
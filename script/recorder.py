@@ -0,0 +1,149 @@
+import os
+import time
+import tempfile
+import numpy as np
+
+from typing import Dict, List, Optional, Tuple
+
+
+Frame = Dict[str, np.ndarray]
+
+
+class StateRecorder:
+    # Keeps the last `capacity` frames in memory and, with a path, streams every frame to
+    # disk in chunks. The ring slots keep their arrays between laps, so once the buffer has
+    # gone round once capturing is only copies into memory that already exists. Every recorder
+    # writes into a session folder of its own under `path`, so earlier runs and other scenes
+    # sharing the folder are never read back as this one's frames
+    CHUNK_PATTERN = "frames_%08d_%08d.npz"
+
+    def __init__(self, capacity=600, path: str=None, chunk_size=300):
+        self.capacity = capacity
+        self.slots: List[Frame] = [{} for _ in range(capacity)]
+        self.slot_steps = np.full(capacity, -1, dtype=np.int64)
+
+        self.path = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.path = tempfile.mkdtemp(prefix=time.strftime("session_%Y%m%d_%H%M%S_"), dir=path)
+
+        self.chunk_size = chunk_size
+        self.chunk_buffers: Frame = {}
+        self.chunk_steps = np.zeros(chunk_size, dtype=np.int64)
+        self.chunk_length = 0
+
+        # Chunk files this recorder wrote as (first step, last step, path), and the last one read
+        self.chunk_index: List[Tuple[int, int, str]] = []
+        self.loaded_chunk: Tuple[str, Dict[str, np.ndarray]] = None
+
+    @staticmethod
+    def copy_into(target: Frame, frame: Frame):
+        for key, value in frame.items():
+            value = np.asarray(value)
+            buffer = target.get(key)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                target[key] = value.copy()
+            else:
+                np.copyto(buffer, value)
+
+        for key in target.keys() - frame.keys():
+            del target[key]
+
+    def capture(self, step: int, frame: Frame):
+        slot = step % self.capacity
+        self.copy_into(self.slots[slot], frame)
+        self.slot_steps[slot] = step
+
+        if self.path is not None:
+            self.append_chunk(step, frame)
+
+    def append_chunk(self, step: int, frame: Frame):
+        # A chunk stacks frames of the same layout, a new key or shape starts the next one
+        if self.chunk_length > 0:
+            same_layout = self.chunk_buffers.keys() == frame.keys() and all(
+                self.chunk_buffers[key].shape[1:] == np.shape(value) for key, value in frame.items())
+            if not same_layout or step != self.chunk_steps[self.chunk_length - 1] + 1:
+                self.flush()
+
+        if self.chunk_length == 0:
+            self.chunk_buffers = {key: np.empty((self.chunk_size, *np.shape(value)), dtype=np.asarray(value).dtype)
+                                  for key, value in frame.items()}
+
+        for key, value in frame.items():
+            self.chunk_buffers[key][self.chunk_length] = value
+        self.chunk_steps[self.chunk_length] = step
+        self.chunk_length += 1
+
+        if self.chunk_length == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.path is None or self.chunk_length == 0:
+            return
+
+        first_step = int(self.chunk_steps[0])
+        last_step = int(self.chunk_steps[self.chunk_length - 1])
+        chunk_path = os.path.join(self.path, self.CHUNK_PATTERN % (first_step, last_step))
+
+        arrays = {key: buffer[:self.chunk_length] for key, buffer in self.chunk_buffers.items()}
+        np.savez(chunk_path, **arrays)
+
+        self.chunk_index = [chunk for chunk in self.chunk_index if chunk[2] != chunk_path]
+        self.chunk_index.append((first_step, last_step, chunk_path))
+        self.chunk_length = 0
+
+    def frame_from_disk(self, step: int) -> Optional[Frame]:
+        # The newest chunk covering the step wins, a rerun over the same steps replaces older ones
+        for first_step, last_step, chunk_path in reversed(self.chunk_index):
+            if first_step <= step <= last_step:
+                break
+        else:
+            return None
+
+        if self.loaded_chunk is None or self.loaded_chunk[0] != chunk_path:
+            with np.load(chunk_path) as data:
+                self.loaded_chunk = (chunk_path, {key: data[key] for key in data.files})
+
+        return {key: array[step - first_step] for key, array in self.loaded_chunk[1].items()}
+
+    def frame(self, step: int) -> Frame:
+        slot = step % self.capacity
+        if self.slot_steps[slot] == step:
+            return self.slots[slot]
+
+        for index in range(self.chunk_length):
+            if self.chunk_steps[index] == step:
+                return {key: buffer[index] for key, buffer in self.chunk_buffers.items()}
+
+        frame = self.frame_from_disk(step) if self.path is not None else None
+        if frame is None:
+            raise KeyError("Step %d is not recorded" % step)
+        return frame
+
+    @property
+    def first_step(self) -> int:
+        steps = [int(self.slot_steps[self.slot_steps >= 0].min())] if (self.slot_steps >= 0).any() else []
+        steps.extend(first_step for first_step, _, _ in self.chunk_index)
+        return min(steps) if steps else -1
+
+    @property
+    def last_step(self) -> int:
+        return int(self.slot_steps.max())
+
+    @staticmethod
+    def divergence(frame_a: Frame, frame_b: Frame) -> float:
+        # Largest difference between two frames, inf when their layouts do not match
+        if frame_a.keys() != frame_b.keys():
+            return float("inf")
+
+        largest = 0.0
+        for key, value in frame_a.items():
+            other = np.asarray(frame_b[key])
+            if np.shape(value) != other.shape:
+                return float("inf")
+            if other.size:
+                largest = max(largest, float(np.abs(np.asarray(value, dtype=float) - other).max()))
+        return largest
+
+    def close(self):
+        self.flush()
@@ -1,108 +1,428 @@
 import math
-from typing import List
+import sys
+from typing import List, Tuple
 import pygame
+import numpy as np
 
 from foundation import ManagedWindow, Entity, Color, Vector3D, InputSystem
+from batch_render import draw_segments, map_colors
+from mesh import Mesh
+from mesh_loader import load_obj
 
 
-class Cube:
-    def __init__(self, position: Vector3D, size):
+class Matrix:
+    @staticmethod
+    def translation(offset: Vector3D) -> np.ndarray:
+        matrix = np.identity(4)
+        matrix[:3, 3] = offset
+        return matrix
+
+    @staticmethod
+    def scale(factor: float) -> np.ndarray:
+        matrix = np.identity(4)
+        matrix[0, 0] = matrix[1, 1] = matrix[2, 2] = factor
+        return matrix
+
+    @staticmethod
+    def rotations(angles: np.ndarray) -> np.ndarray:
+        # (n, 3) Euler angles in radians, applied x, then y, then z, to (n, 3, 3) rotations
+        angles = np.asarray(angles, dtype=float).reshape(-1, 3)
+        cos_x, cos_y, cos_z = np.cos(angles).T
+        sin_x, sin_y, sin_z = np.sin(angles).T
+
+        matrices = np.empty((len(angles), 3, 3))
+        matrices[:, 0, 0] = cos_z * cos_y
+        matrices[:, 0, 1] = cos_z * sin_y * sin_x - sin_z * cos_x
+        matrices[:, 0, 2] = cos_z * sin_y * cos_x + sin_z * sin_x
+        matrices[:, 1, 0] = sin_z * cos_y
+        matrices[:, 1, 1] = sin_z * sin_y * sin_x + cos_z * cos_x
+        matrices[:, 1, 2] = sin_z * sin_y * cos_x - cos_z * sin_x
+        matrices[:, 2, 0] = -sin_y
+        matrices[:, 2, 1] = cos_y * sin_x
+        matrices[:, 2, 2] = cos_y * cos_x
+        return matrices
+
+    @staticmethod
+    def rotation(angles: Vector3D) -> np.ndarray:
+        matrix = np.identity(4)
+        matrix[:3, :3] = Matrix.rotations(angles)[0]
+        return matrix
+
+    @staticmethod
+    def models(positions: np.ndarray, rotations: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        # translation @ rotation @ scale for many instances at once, (n, 4, 4)
+        matrices = np.zeros((len(positions), 4, 4))
+        matrices[:, :3, :3] = Matrix.rotations(rotations) * np.asarray(scales, dtype=float)[:, None, None]
+        matrices[:, :3, 3] = positions
+        matrices[:, 3, 3] = 1
+        return matrices
+
+    @staticmethod
+    def projection(focal_length: float, center: Tuple[float, float]) -> np.ndarray:
+        # Screen x = center x - x / z * focal length, the same for y. w holds the view
+        # depth and z holds 1, so z / w comes out as inverse depth
+        return np.array((
+            (-focal_length, 0, center[0], 0),
+            (0, -focal_length, center[1], 0),
+            (0, 0, 0, 1),
+            (0, 0, 1, 0)))
+
+
+class MeshInstance:
+    # Only a transform and a colour, the vertex and edge arrays stay on the mesh
+    def __init__(self, mesh: Mesh, position: Vector3D, size=1, rotation: Vector3D=(0, 0, 0), color=None):
+        self.mesh = mesh
         self.position: Vector3D = position
         self.size = size
+        self.rotation: Vector3D = rotation
+        self.color = Color.WHITE if color is None else color
+
+    def model_matrix(self) -> np.ndarray:
+        return Matrix.models([self.position], [self.rotation], [self.size])[0]
 
-        x, y, z = position
+    def bounding_sphere(self) -> Tuple[Vector3D, float]:
+        center = self.model_matrix()[:3] @ np.append(self.mesh.bounding_center, 1)
+        return tuple(center), self.mesh.bounding_radius * abs(self.size)
 
-        self.positions: List[Vector3D] = [
-            (x + size, y + size, z + size), # 0
-            (x - size, y + size, z + size), # 1
-            (x + size, y - size, z + size), # 2
-            (x - size, y - size, z + size), # 3
-            (x + size, y + size, z - size), # 4
-            (x - size, y + size, z - size), # 5
-            (x + size, y - size, z - size), # 6
-            (x - size, y - size, z - size), # 7
-        ]
 
-        self.lines = [
-            (0, 1),
-            (0, 2),
-            (0, 4),
+CUBE_MESH = Mesh(
+    vertices=(
+        (1, 1, 1), # 0
+        (-1, 1, 1), # 1
+        (1, -1, 1), # 2
+        (-1, -1, 1), # 3
+        (1, 1, -1), # 4
+        (-1, 1, -1), # 5
+        (1, -1, -1), # 6
+        (-1, -1, -1), # 7
+    ),
+    lines=(
+        (0, 1),
+        (0, 2),
+        (0, 4),
 
-            (1, 3),
-            (1, 5),
+        (1, 3),
+        (1, 5),
 
-            (2, 3),
-            (2, 6),
+        (2, 3),
+        (2, 6),
 
-            (3, 7),
+        (3, 7),
 
-            (4, 5),
-            (4, 6),
+        (4, 5),
+        (4, 6),
 
-            (5, 7),
+        (5, 7),
 
-            (6, 7),
-        ]
+        (6, 7),
+    ),
+    # Counter clockwise seen from outside
+    faces=(
+        (0, 1, 3), (0, 3, 2),
+        (4, 6, 7), (4, 7, 5),
+        (0, 2, 6), (0, 6, 4),
+        (1, 5, 7), (1, 7, 3),
+        (0, 4, 5), (0, 5, 1),
+        (2, 3, 7), (2, 7, 6),
+    ))
+
+
+class Cube(MeshInstance):
+    def __init__(self, position: Vector3D, size, rotation: Vector3D=(0, 0, 0), color=None):
+        super().__init__(CUBE_MESH, position, size=size, rotation=rotation, color=color)
+
+
+class InstanceBatch:
+    # Transforms of every instance of one mesh gathered into arrays for a frame
+    def __init__(self, mesh: Mesh, instances: List[MeshInstance], window: ManagedWindow):
+        self.mesh = mesh
+        self.instances = instances
+
+        self.positions = np.array([instance.position for instance in instances], dtype=float).reshape(-1, 3)
+        self.rotations = np.array([instance.rotation for instance in instances], dtype=float).reshape(-1, 3)
+        self.sizes = np.array([instance.size for instance in instances], dtype=float)
+        self.colors = np.array([window.surface.map_rgb(instance.color) for instance in instances])
+
+    def select(self, keep: np.ndarray):
+        self.instances = [instance for instance, visible in zip(self.instances, keep.tolist()) if visible]
+        self.positions = self.positions[keep]
+        self.rotations = self.rotations[keep]
+        self.sizes = self.sizes[keep]
+        self.colors = self.colors[keep]
+
+    def models(self) -> np.ndarray:
+        return Matrix.models(self.positions, self.rotations, self.sizes)
+
+    def bounding_spheres(self) -> Tuple[np.ndarray, np.ndarray]:
+        centers = self.positions + np.einsum("nij,j->ni", Matrix.rotations(self.rotations), self.mesh.bounding_center) * self.sizes[:, None]
+        return centers, self.mesh.bounding_radius * np.abs(self.sizes)
 
 
 class Camera(Entity):
-    def __init__(self, position: Vector3D):
+    WIREFRAME = "wireframe"
+    SOLID = "solid"
+
+    def __init__(self, position: Vector3D, rotation: Vector3D=(0, 0, 0), render_mode=WIREFRAME):
         self.position: Vector3D = position
+        self.rotation: Vector3D = rotation
         self.move_speed: Vector3D = (10, 10, 1)
 
-        self.render_objects: List[Cube] = []
+        self.render_objects: List[MeshInstance] = []
         self.scale = 10
+        self.focal_length = 10
+        self.near = 0.1
 
-    def update(self, delta_time: float):
+        self.render_mode = render_mode
+        # Direction the light travels in, from behind and above the camera
+        self.light_direction = np.array((-0.3, -0.5, 0.8)) / np.linalg.norm((-0.3, -0.5, 0.8))
+        self.ambient = 0.2
+        self.depth_buffer: np.ndarray = None
+
+        self.visible_count = 0
+
+        # Movement from the held actions, only worked out again when they change
+        self.input_version = -1
+        self.velocity: Vector3D = (0, 0, 0)
+
+    def update_velocity(self):
         delta_x = 0
         delta_y = 0
         delta_z = 0
-        if InputSystem.KEY_A:
+        if InputSystem.is_held(InputSystem.LEFT):
             delta_x += self.move_speed[0]
-        if InputSystem.KEY_D:
+        if InputSystem.is_held(InputSystem.RIGHT):
             delta_x -= self.move_speed[0]
 
-        if InputSystem.KEY_Q:
+        if InputSystem.is_held(InputSystem.DOWN):
             delta_y -= self.move_speed[1]
-        if InputSystem.KEY_E:
+        if InputSystem.is_held(InputSystem.UP):
             delta_y += self.move_speed[1]
 
-        if InputSystem.KEY_W:
+        if InputSystem.is_held(InputSystem.FORWARD):
             delta_z -= self.move_speed[2]
-        if InputSystem.KEY_S:
+        if InputSystem.is_held(InputSystem.BACK):
             delta_z += self.move_speed[2]
-        
+
+        self.velocity = (delta_x, delta_y, delta_z)
+
+    def update(self, delta_time: float):
+        if self.input_version != InputSystem.action_version:
+            self.input_version = InputSystem.action_version
+            self.update_velocity()
+
+        if self.velocity == (0, 0, 0):
+            return
+
+        delta_x, delta_y, delta_z = self.velocity
         self.position = self.position[0] + (delta_x * delta_time), self.position[1] + (delta_y * delta_time), self.position[2] + (delta_z * delta_time)
 
-    def draw(self, window: ManagedWindow):
-        for render_object in self.render_objects:
-            self.draw_object(window, render_object)
-    
-    def draw_object(self, window: ManagedWindow, render_object: Cube):
+    def view_matrix(self) -> np.ndarray:
+        return Matrix.rotation(self.rotation).T @ Matrix.translation(np.negative(self.position))
+
+    def view_projection_matrix(self, window: ManagedWindow) -> np.ndarray:
         center = window.size[0] / 2, window.size[1] / 2
+        return Matrix.projection(self.focal_length * self.scale, center) @ self.view_matrix()
+
+    def batches(self, window: ManagedWindow, render_objects: List[MeshInstance]) -> List[InstanceBatch]:
+        instances_by_mesh = {}
+        for render_object in render_objects:
+            instances_by_mesh.setdefault(id(render_object.mesh), []).append(render_object)
+
+        return [InstanceBatch(instances[0].mesh, instances, window) for instances in instances_by_mesh.values()]
+
+    def frustum_cull(self, window: ManagedWindow, batch: InstanceBatch):
+        # Bounding spheres against the near plane and the four side planes, all in view space
+        centers, radiuses = batch.bounding_spheres()
+
+        view = self.view_matrix()
+        centers = centers @ view[:3, :3].T + view[:3, 3]
+
+        focal_length = self.focal_length * self.scale
+        half_width, half_height = window.size[0] / 2, window.size[1] / 2
+        x, y, z = centers[:, 0], centers[:, 1], centers[:, 2]
+
+        visible = z + radiuses >= self.near
+        for offset, half_size in ((x, half_width), (-x, half_width), (y, half_height), (-y, half_height)):
+            visible &= (focal_length * offset - half_size * z) / math.hypot(focal_length, half_size) <= radiuses
+
+        batch.select(visible)
+
+    def project(self, window: ManagedWindow, batch: InstanceBatch) -> np.ndarray:
+        # Every vertex of every instance of the mesh in one product, (instances, vertices, 4).
+        # The translation column is added separately, so no homogeneous copy of the vertices is needed
+        transforms = self.view_projection_matrix(window) @ batch.models()
+        return np.einsum("nij,vj->nvi", transforms[:, :, :3], batch.mesh.vertices) + transforms[:, None, :, 3]
+
+    def draw(self, window: ManagedWindow):
+        self.visible_count = 0
+        if self.render_objects:
+            self.draw_objects(window, self.render_objects)
+
+    def draw_object(self, window: ManagedWindow, render_object: MeshInstance):
+        self.draw_objects(window, [render_object])
+
+    def clip_near(self, starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Clip space w is the view depth, cut every edge where it crosses the near plane
+        start_in_front = starts[:, 3] >= self.near
+        end_in_front = ends[:, 3] >= self.near
+        keep = start_in_front | end_in_front
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percentage = (self.near - starts[:, 3]) / (ends[:, 3] - starts[:, 3])
+            crossing = starts + (ends - starts) * percentage[:, None]
+
+        starts = np.where(start_in_front[:, None], starts, crossing)
+        ends = np.where(end_in_front[:, None], ends, crossing)
+        return starts[keep], ends[keep], keep
+
+    def draw_objects(self, window: ManagedWindow, render_objects: List[MeshInstance]):
+        if self.render_mode == self.SOLID:
+            self.draw_solid(window, render_objects)
+        else:
+            self.draw_wireframe(window, render_objects)
+
+    def draw_solid(self, window: ManagedWindow, render_objects: List[MeshInstance]):
+        # Inverse depth buffer, 0 is infinitely far so the clear value loses against any face
+        if self.depth_buffer is None or self.depth_buffer.shape != window.surface.get_size():
+            self.depth_buffer = np.zeros(window.surface.get_size())
+        else:
+            self.depth_buffer.fill(0)
+
+        for batch in self.batches(window, render_objects):
+            self.frustum_cull(window, batch)
+            self.visible_count += len(batch.instances)
+            if not batch.instances or len(batch.mesh.faces) == 0:
+                continue
+
+            faces = batch.mesh.faces
+            triangles = self.project(window, batch)[:, faces].reshape(-1, 3, 4)
+            face_colors = np.repeat(np.array([instance.color for instance in batch.instances], dtype=float), len(faces), axis=0)
+
+            # Faces reaching behind the near plane are dropped whole
+            in_front = (triangles[:, :, 3] >= self.near).all(axis=1)
+            points = triangles[:, :, :2] / np.where(in_front[:, None], triangles[:, :, 3], 1)[:, :, None]
+
+            # Counter clockwise faces turn clockwise on screen (y points down), anything else faces away
+            keep = in_front & (edge_function(points[:, 0], points[:, 1], points[:, 2]) < 0)
+            if not keep.any():
+                continue
+
+            # Flat shading from the world space normal
+            world = np.einsum("nij,vj->nvi", batch.models()[:, :3, :3], batch.mesh.vertices) + batch.positions[:, None, :]
+            world = world[:, faces].reshape(-1, 3, 3)[keep]
+            normals = np.cross(world[:, 1] - world[:, 0], world[:, 2] - world[:, 0])
+            normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+            light = self.ambient + (1 - self.ambient) * np.clip(normals @ -self.light_direction, 0, 1)
+
+            colors = map_colors(window.surface, face_colors[keep] * light[:, None])
+            rasterize_triangles(window.surface, self.depth_buffer, points[keep], 1 / triangles[keep][:, :, 3], colors)
+
+    def draw_wireframe(self, window: ManagedWindow, render_objects: List[MeshInstance]):
+        all_starts, all_ends, all_colors = [], [], []
+
+        for batch in self.batches(window, render_objects):
+            self.frustum_cull(window, batch)
+            self.visible_count += len(batch.instances)
+            if not batch.instances:
+                continue
+
+            clip = self.project(window, batch)
+            lines = batch.mesh.lines
+            all_starts.append(clip[:, lines[:, 0]].reshape(-1, 4))
+            all_ends.append(clip[:, lines[:, 1]].reshape(-1, 4))
+            all_colors.append(np.repeat(batch.colors, len(lines)))
+
+        if not all_starts:
+            return
+
+        starts, ends, keep = self.clip_near(np.concatenate(all_starts), np.concatenate(all_ends))
+        line_colors = np.concatenate(all_colors)[keep]
+
+        starts = starts[:, :2] / starts[:, 3:4]
+        ends = ends[:, :2] / ends[:, 3:4]
+
+        # One rasterizer call per colour instead of one pygame.draw.line per edge
+        for color in np.unique(line_colors).tolist():
+            same_color = line_colors == color
+            draw_segments(window.surface, starts[same_color], ends[same_color], color)
+
+
+def edge_function(point_a: np.ndarray, point_b: np.ndarray, point_c: np.ndarray) -> np.ndarray:
+    # Twice the signed area of abc, the sign tells which side of ab the point c is on
+    return ((point_b[..., 0] - point_a[..., 0]) * (point_c[..., 1] - point_a[..., 1]) -
+            (point_b[..., 1] - point_a[..., 1]) * (point_c[..., 0] - point_a[..., 0]))
+
+
+def rasterize_triangles(surface: pygame.Surface, depth_buffer: np.ndarray, points: np.ndarray,
+                        inverse_depths: np.ndarray, colors: np.ndarray, max_fragments=1 << 21):
+    # Every pixel of every triangle's bounding box becomes a candidate fragment in one array,
+    # the chunks only bound memory. points (n, 3, 2), inverse_depths (n, 3), colors mapped (n,)
+    width, height = surface.get_size()
+
+    low = np.floor(points.min(axis=1)).astype(np.intp)
+    high = np.ceil(points.max(axis=1)).astype(np.intp)
+    on_screen = (high[:, 0] >= 0) & (high[:, 1] >= 0) & (low[:, 0] < width) & (low[:, 1] < height)
+
+    points, inverse_depths, colors = points[on_screen], inverse_depths[on_screen], colors[on_screen]
+    low = np.maximum(low[on_screen], 0)
+    high = np.minimum(high[on_screen], (width - 1, height - 1))
+
+    sizes = high - low + 1
+    counts = sizes[:, 0] * sizes[:, 1]
+    areas = edge_function(points[:, 0], points[:, 1], points[:, 2])
+
+    pixels = pygame.surfarray.pixels2d(surface)
+    flat_depth = depth_buffer.reshape(-1)
+
+    start = 0
+    while start < len(points):
+        end = start + max(int(np.searchsorted(np.cumsum(counts[start:]), max_fragments, side="right")), 1)
+
+        triangle = np.repeat(np.arange(start, end), counts[start:end])
+        local = np.arange(len(triangle)) - np.repeat(np.cumsum(counts[start:end]) - counts[start:end], counts[start:end])
+        x = low[triangle, 0] + local % sizes[triangle, 0]
+        y = low[triangle, 1] + local // sizes[triangle, 0]
+        center = np.stack((x + 0.5, y + 0.5), axis=1)
+
+        corners = points[triangle]
+        weight_a = edge_function(corners[:, 1], corners[:, 2], center) / areas[triangle]
+        weight_b = edge_function(corners[:, 2], corners[:, 0], center) / areas[triangle]
+        weight_c = 1 - weight_a - weight_b
+        inside = (weight_a >= 0) & (weight_b >= 0) & (weight_c >= 0)
+
+        depth = (weight_a * inverse_depths[triangle, 0] + weight_b * inverse_depths[triangle, 1] +
+                 weight_c * inverse_depths[triangle, 2])[inside]
+        triangle, x, y = triangle[inside], x[inside], y[inside]
+        pixel = x * height + y
+
+        # Closest fragment per pixel first, then only where it beats what is already in the buffer
+        order = np.lexsort((-depth, pixel))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = pixel[order[1:]] != pixel[order[:-1]]
+        nearest = order[first]
+        nearest = nearest[depth[nearest] > flat_depth[pixel[nearest]]]
 
-        transformed_points = []
-        for point in render_object.positions:
-            delta = (point[0] - self.position[0], point[1] - self.position[1], point[2] - self.position[2])
-            multiplier = math.fabs(delta[2] / self.position[2])
+        flat_depth[pixel[nearest]] = depth[nearest]
+        pixels[x[nearest], y[nearest]] = colors[triangle[nearest]]
 
-            transformed_point = (
-                center[0] - (delta[0] / multiplier * self.scale),
-                center[1] - (delta[1] / multiplier * self.scale))
+        start = end
 
-            transformed_points.append(transformed_point)
-        
-        for line in render_object.lines:
-            pygame.draw.line(window.surface, Color.WHITE, transformed_points[line[0]], transformed_points[line[1]])
+    del pixels
 
 
 class App:
     def main(self):
         window = ManagedWindow((400, 400), step_update=False, tick=30)
 
-        cube = Cube((0, 0, 40), 10)
-        camera = Camera((0, 0, -10))
-        camera.render_objects.append(cube)
+        arguments = [argument for argument in sys.argv[1:] if argument != "--solid"]
+        camera = Camera((0, 0, -10), render_mode=Camera.SOLID if "--solid" in sys.argv else Camera.WIREFRAME)
+        if arguments:
+            # Any Wavefront OBJ, scaled so its bounding sphere fills about the same space as the cube
+            mesh = load_obj(arguments[0])
+            size = 10 / max(mesh.bounding_radius, 1e-9)
+            camera.render_objects.append(MeshInstance(mesh, tuple(-mesh.bounding_center * size + (0, 0, 40)), size))
+        else:
+            camera.render_objects.append(Cube((0, 0, 40), 10, rotation=(0.5, 0.6, 0), color=Color.ORANGE))
         window.children.append(camera)
 
         window.run()
@@ -0,0 +1,99 @@
+import pygame
+
+from collections import OrderedDict
+from typing import Dict, Sequence, Tuple
+
+
+ShapeKey = Tuple[str, int, int, Tuple[int, ...]]
+
+
+class ShapeCache:
+    # Pre-rasterized shapes keyed by (shape, radius, width, colour), least recently used goes
+    # first when full. A scene only draws a handful of distinct markers, so the cache turns
+    # most per frame rasterizing into blits. The counters tell whether `capacity` is enough.
+    # Callers may hold on to a surface they were handed, eviction only drops the cache's copy
+    CIRCLE = "circle"
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.surfaces: "OrderedDict[ShapeKey, pygame.Surface]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def render(shape: str, radius: int, width: int, color: Tuple[int, ...]) -> pygame.Surface:
+        if shape != ShapeCache.CIRCLE:
+            raise ValueError("Unknown shape %r" % shape)
+
+        # Anything that is not the shape colour works as the transparent key
+        key = (0, 0, 0) if color[:3] != (0, 0, 0) else (255, 0, 255)
+        surface = pygame.Surface((radius * 2, radius * 2))
+        surface.fill(key)
+        pygame.draw.circle(surface, color, (radius, radius), radius, width)
+        surface.set_colorkey(key, pygame.RLEACCEL)
+        return surface
+
+    def get(self, shape: str, radius: int, width: int, color: Sequence[int]) -> pygame.Surface:
+        key = (shape, int(radius), int(width), tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = self.render(*key)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.capacity:
+            self.surfaces.popitem(last=False)
+            self.evictions += 1
+        return surface
+
+    def circle(self, color: Sequence[int], radius: int, width=0) -> pygame.Surface:
+        return self.get(self.CIRCLE, radius, width, color)
+
+    def draw_circle(self, surface: pygame.Surface, color: Sequence[int], center: Sequence[float],
+                    radius: int, width=0) -> pygame.Rect:
+        # Same pixels as pygame.draw.circle, which truncates the centre to whole pixels. Called for
+        # every marker every frame, so a hit is one lookup with the arguments as they come and only
+        # a miss or an unhashable colour goes through get
+        key = (self.CIRCLE, radius, width, color)
+        try:
+            shape = self.surfaces[key]
+        except (KeyError, TypeError):
+            shape = self.get(self.CIRCLE, radius, width, color)
+        else:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+
+        radius = int(radius)
+        return surface.blit(shape, (int(center[0]) - radius, int(center[1]) - radius))
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": len(self.surfaces),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self.surfaces.clear()
+
+
+# Shared by every entity, one set of marker surfaces for the whole process
+SHAPES = ShapeCache()
@@ -0,0 +1,204 @@
+import math
+import numpy as np
+
+from typing import Dict, Hashable, List, Set, Tuple
+
+try:
+    from .foundation import Vector
+except ImportError:
+    from foundation import Vector
+
+
+Cell = Tuple[int, int]
+
+
+class RebuildBudget:
+    # An index only pays off when enough queries read it before the nodes move again. Counts
+    # the queries of this step and the last one, the owner answers with a brute force test
+    # until either reaches `break_even`, then rebuilds once per step
+    def __init__(self, break_even: int):
+        self.break_even = break_even
+        self.dirty = True
+
+        self.step_queries = 0
+        self.previous_step_queries = 0
+
+    def invalidate(self):
+        self.dirty = True
+
+    def end_step(self):
+        self.previous_step_queries = self.step_queries
+        self.step_queries = 0
+        self.dirty = True
+
+    def use_index(self) -> bool:
+        self.step_queries += 1
+        return not self.dirty or max(self.step_queries, self.previous_step_queries) >= self.break_even
+
+    def rebuilt(self):
+        self.dirty = False
+
+
+class SpatialHash:
+    # Object keyed hash, meant for a handful of moving things like ClickablePoint,
+    # `move` only touches the buckets when the key crosses a cell border
+    # Moving a 20 node chain in costs about 16 per node loops over it, see RebuildBudget
+    REBUILD_QUERIES = 16
+
+    def __init__(self, cell_size: float=30):
+        self.cell_size = cell_size
+
+        self.cells: Dict[Cell, Set[Hashable]] = {}
+        self.positions: Dict[Hashable, Vector] = {}
+        self.key_cells: Dict[Hashable, Cell] = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def cell_of(self, position: Vector) -> Cell:
+        return (math.floor(position[0] / self.cell_size), math.floor(position[1] / self.cell_size))
+
+    def insert(self, key: Hashable, position: Vector):
+        cell = self.cell_of(position)
+        self.positions[key] = position
+        self.key_cells[key] = cell
+        self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key: Hashable):
+        cell = self.key_cells.pop(key)
+        del self.positions[key]
+
+        bucket = self.cells[cell]
+        bucket.discard(key)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, key: Hashable, position: Vector):
+        if key not in self.positions:
+            self.insert(key, position)
+            return
+
+        self.positions[key] = position
+
+        cell = self.cell_of(position)
+        old_cell = self.key_cells[key]
+        if cell == old_cell:
+            return
+
+        bucket = self.cells[old_cell]
+        bucket.discard(key)
+        if not bucket:
+            del self.cells[old_cell]
+
+        self.key_cells[key] = cell
+        self.cells.setdefault(cell, set()).add(key)
+
+    def query_radius(self, center: Vector, radius: float) -> List[Hashable]:
+        min_x, min_y = self.cell_of((center[0] - radius, center[1] - radius))
+        max_x, max_y = self.cell_of((center[0] + radius, center[1] + radius))
+        sqr_radius = radius * radius
+
+        result = []
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                bucket = self.cells.get((cell_x, cell_y))
+                if bucket is None:
+                    continue
+
+                for key in bucket:
+                    position = self.positions[key]
+                    if (position[0] - center[0]) ** 2 + (position[1] - center[1]) ** 2 <= sqr_radius:
+                        result.append(key)
+        return result
+
+
+class UniformGrid:
+    # Array backed hash grid for node arrays (cloth, vine field). Rebuilding is one
+    # sort of the hashed cell ids, queries only read the buckets around the center
+    PRIME_X = 73856093
+    PRIME_Y = 19349663
+
+    # A rebuild costs about 7 brute force radius queries over the same nodes, see bench_spatial.py
+    REBUILD_QUERIES = 8
+
+    def __init__(self, cell_size: float=20):
+        self.cell_size = cell_size
+
+        self.table_size = 1
+        self.positions: np.ndarray = np.zeros((0, 2))
+        self.cells: np.ndarray = np.zeros((0, 2), dtype=np.int64)
+        self.sorted_indices: np.ndarray = np.zeros(0, dtype=np.intp)
+        self.bucket_starts: np.ndarray = np.zeros(2, dtype=np.intp)
+
+    def hash_cells(self, cell_x: np.ndarray, cell_y: np.ndarray) -> np.ndarray:
+        return ((cell_x * self.PRIME_X) ^ (cell_y * self.PRIME_Y)) & (self.table_size - 1)
+
+    def rebuild(self, positions: np.ndarray):
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+
+        # Power of two table, roughly two buckets per node keeps collisions rare
+        self.table_size = 1 << max(int(len(positions) * 2 - 1).bit_length(), 4)
+        self.positions = positions
+
+        cells = np.floor(positions / self.cell_size).astype(np.int64)
+        self.cells = cells
+        hashes = self.hash_cells(cells[:, 0], cells[:, 1])
+
+        self.sorted_indices = np.argsort(hashes, kind="stable")
+        self.bucket_starts = np.zeros(self.table_size + 1, dtype=np.intp)
+        np.cumsum(np.bincount(hashes, minlength=self.table_size), out=self.bucket_starts[1:])
+
+    def query_radius(self, center: Vector, radius: float) -> np.ndarray:
+        min_x = math.floor((center[0] - radius) / self.cell_size)
+        min_y = math.floor((center[1] - radius) / self.cell_size)
+        max_x = math.floor((center[0] + radius) / self.cell_size)
+        max_y = math.floor((center[1] + radius) / self.cell_size)
+
+        cell_x, cell_y = np.meshgrid(np.arange(min_x, max_x + 1, dtype=np.int64), np.arange(min_y, max_y + 1, dtype=np.int64))
+        hashes = np.unique(self.hash_cells(cell_x.ravel(), cell_y.ravel()))
+
+        candidates = [self.sorted_indices[self.bucket_starts[bucket]:self.bucket_starts[bucket + 1]] for bucket in hashes.tolist()]
+        if not candidates:
+            return np.zeros(0, dtype=np.intp)
+        candidates = np.concatenate(candidates)
+
+        delta = self.positions[candidates] - center
+        return candidates[np.einsum("ij,ij->i", delta, delta) <= radius * radius]
+
+    def query_pairs(self, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        # Every pair of indexed nodes closer than `radius`, once each with first < second.
+        # Each node reads the buckets of the cells around its own, expanded as flat arrays
+        node_count = len(self.positions)
+        reach = max(math.ceil(radius / self.cell_size), 1)
+        owners = np.arange(node_count)
+
+        first_parts = []
+        second_parts = []
+        for offset_x in range(-reach, reach + 1):
+            for offset_y in range(-reach, reach + 1):
+                buckets = self.hash_cells(self.cells[:, 0] + offset_x, self.cells[:, 1] + offset_y)
+                starts = self.bucket_starts[buckets]
+                counts = self.bucket_starts[buckets + 1] - starts
+
+                slot_owners = np.repeat(owners, counts)
+                slots = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+                others = self.sorted_indices[slots]
+
+                keep = slot_owners < others
+                first_parts.append(slot_owners[keep])
+                second_parts.append(others[keep])
+
+        if node_count == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+        # Different cells can land in the same bucket, so a pair may have been seen more than once
+        keys = np.unique(np.concatenate(first_parts) * node_count + np.concatenate(second_parts))
+        first = keys // node_count
+        second = keys % node_count
+
+        delta = self.positions[second] - self.positions[first]
+        close = np.einsum("ij,ij->i", delta, delta) <= radius * radius
+        return first[close], second[close]
@@ -1,39 +1,39 @@
 import pygame
+import numpy as np
 import csv
 import math
+import sys
 
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 try:
-    from .foundation import ManagedWindow, Entity, InputSystem, Color, Math
+    from .foundation import ManagedWindow, Entity, InputSystem, InputTimeline, DebugDraw, Color, Math, Vec2
     from .bezier_curve import ClickablePoint
+    from .spatial import RebuildBudget, SpatialHash, UniformGrid
+    from .batch_render import draw_polylines
 except ImportError:
-    from foundation import ManagedWindow, Entity, InputSystem, Color, Math
+    from foundation import ManagedWindow, Entity, InputSystem, InputTimeline, DebugDraw, Color, Math, Vec2
     from bezier_curve import ClickablePoint
+    from spatial import RebuildBudget, SpatialHash, UniformGrid
+    from batch_render import draw_polylines
 
 
-class Gizmos:
-    Line = 1
-    Dot = 2
-
-    def __init__(self, type_, color, argument):
-        self.type = type_
-        self.color = color
-        self.argument = argument
+# F5 shows the forces of every Vine node
+VINE_DEBUG_CHANNEL = DebugDraw.add_channel("vine", pygame.K_F5)
 
 
 class VineNode:
     def __init__(self, position, velocity=(0, 0), acceration=(0, 0), magnitude=0) -> None:
-        self.position = position
-        self.velocity = velocity
-        self.acceration = acceration
+        self.position = Vec2(*position)
+        self.velocity = Vec2(*velocity)
+        self.acceration = Vec2(*acceration)
         self.magnitude = magnitude
         self.mass = 1
 
 
 class Vine(Entity):
     def __init__(self, start_position, node_delta=(0, 25), length=10, gravity=(0, 10),
-                 parent_node_delta=False):
+                 parent_node_delta=False, spatial_index: SpatialHash=None):
         self.points: List[VineNode] = []
 
         self.points.append(VineNode(start_position))
@@ -44,97 +44,148 @@ class Vine(Entity):
             self.points.append(VineNode(new_pos, magnitude=magnitude))
             start_position = new_pos
         
-        self.gizmos: List[Gizmos] = []
         self.gravity = gravity
         self.records = []
         self.parent_node_delta = parent_node_delta
 
+        # Keyed by this vine's nodes, so the hash can not be shared between vines
+        self.spatial_index = spatial_index
+        self.index_budget = RebuildBudget(SpatialHash.REBUILD_QUERIES)
+
+        # Scratch vectors reused by every node of every update
+        self.pull_direction = Vec2()
+        self.pull_to = Vec2()
+        self.acceleration = Vec2()
+        self.lift_delta = Vec2()
+        self.pull_delta = Vec2()
+        self.suppose_point = Vec2()
+        self.new_position = Vec2()
+        self.length_fix_delta = Vec2()
+        self.delta = Vec2()
+
     def apply_force(self, force_center, force_radius, force_strength):
-        for i, point in enumerate(self.points):
-            sqr_magnitude = Math.sqr_magnitude(point.position, force_center)
-            if sqr_magnitude <= force_radius * force_radius:
-                point.velocity = Math.tuple_plus(point.velocity, force_strength)
+        center_x, center_y = force_center
+        strength_x, strength_y = force_strength
+        sqr_radius = force_radius * force_radius
+
+        if self.spatial_index is not None and self.index_budget.use_index():
+            if self.index_budget.dirty:
+                for point in self.points:
+                    self.spatial_index.move(point, point.position)
+                self.index_budget.rebuilt()
+
+            for point in self.spatial_index.query_radius(force_center, force_radius):
+                point.velocity.add_xy(strength_x, strength_y)
+            return
+
+        for point in self.points:
+            position = point.position
+            if (position.x - center_x) ** 2 + (position.y - center_y) ** 2 <= sqr_radius:
+                point.velocity.add_xy(strength_x, strength_y)
     
     def update(self, delta_time: float):
         delta_time *= 2
         # pull_from = self.points[0].position
         # pull_direction = (0, 1)
 
-        self.gizmos.clear()
+        pull_direction = self.pull_direction
+        pull_to = self.pull_to
+        acceleration = self.acceleration
+        lift_delta = self.lift_delta
+        pull_delta = self.pull_delta
+        suppose_point = self.suppose_point
+        new_position = self.new_position
+        length_fix_delta = self.length_fix_delta
+        delta = self.delta
+        debug_draw = DebugDraw.enabled(VINE_DEBUG_CHANNEL)
 
         for i, point in enumerate(self.points):
             if i == 0:
                 continue
 
+            position = point.position
+            velocity = point.velocity
+
             pull_from = self.points[i - 1].position
             if i >= 2:
-                pull_direction = Math.normalize(Math.tuple_minus(self.points[i - 2].position, pull_from))
+                pull_direction.set_difference(self.points[i - 2].position, pull_from).normalize_ip()
             else:
-                pull_direction = (0, 1)
+                pull_direction.set(0, 1)
 
-            pull_to = (pull_direction[0] * point.magnitude + pull_from[0], pull_direction[1] * point.magnitude + pull_from[1])
-            self.gizmos.append(Gizmos(Gizmos.Dot, Color.YELLOW, pull_to))
+            pull_to.copy_from(pull_from).axpy(point.magnitude, pull_direction)
 
-            acceleration = self.gravity
-            self.gizmos.append(Gizmos(Gizmos.Line, Color.RED, (point.position, Math.tuple_plus(point.position, self.gravity))))
+            acceleration.set(*self.gravity)
 
-            lift_delta = Math.tuple_multiple(Math.tuple_minus(pull_from, point.position), 0.3)
-            acceleration = Math.tuple_plus(acceleration, lift_delta)
-            self.gizmos.append(Gizmos(Gizmos.Line, Color.GREEN, (point.position, Math.tuple_plus(point.position, lift_delta))))
+            lift_delta.set_difference(pull_from, position)
+            lift_delta *= 0.3
+            acceleration += lift_delta
 
-            acceleration = Math.tuple_plus(acceleration, Math.tuple_minus(pull_to, point.position))
-            self.gizmos.append(Gizmos(Gizmos.Line, Color.BLUE, (point.position, pull_to)))
+            acceleration += pull_delta.set_difference(pull_to, position)
 
-            point.velocity = Math.tuple_plus(point.velocity, Math.tuple_multiple(acceleration, delta_time))
+            velocity.axpy(delta_time, acceleration)
 
             #  The new point should be, if without magnitude constrain
-            suppose_point = Math.tuple_plus(point.position, Math.tuple_multiple(point.velocity, delta_time))
+            suppose_point.copy_from(position).axpy(delta_time, velocity)
 
             # The new point constrain by  magnitude
-            new_position = Math.tuple_plus(
-                pull_from,
-                Math.clamp_magnitude(
-                    Math.tuple_minus(suppose_point, pull_from),
-                    point.magnitude))
+            new_position.set_difference(suppose_point, pull_from).clamp_magnitude_ip(point.magnitude)
+            new_position += pull_from
 
-            self.gizmos.append(Gizmos(Gizmos.Line, Color.YELLOW, (new_position, Math.tuple_plus(new_position, point.velocity))))
+            if debug_draw:
+                self.draw_debug(point, new_position)
 
             # Calculate magnitude constrain translate in to velocity and acceleration
-            length_fix_delta = Math.tuple_minus(new_position, suppose_point)
+            length_fix_delta.set_difference(new_position, suppose_point)
 
             # if length_fix_delta > 0.1:
             # Math.tuple_multiple(length_fix_delta, 10)
-            self.gizmos.append(Gizmos(Gizmos.Line, Color.PINK, (point.position, new_position)))
 
-            point.velocity = Math.tuple_plus(point.velocity, Math.tuple_multiple(length_fix_delta, 1))
+            velocity += length_fix_delta
             # point.velocity = Math.tuple_plus(point.velocity, Math.tuple_multiple(Math.tuple_minus(new_position, point.position), 1))
 
-            self.gizmos.append(Gizmos(Gizmos.Line, Color.ORANGE, (point.position, Math.tuple_plus(point.position, acceleration))))
-            # point.velocity = Math.tuple_plus(point.velocity, length_fix_delta)
-
-            delta = Math.tuple_minus(new_position, point.position)
-            point.position = new_position
+            delta.set_difference(new_position, position)
+            position.copy_from(new_position)
 
             if self.parent_node_delta:
                 for e in range(i + 1, len(self.points)):
-                    self.points[e].position = Math.tuple_plus(self.points[e].position, delta)
+                    self.points[e].position += delta
             # self.records.append((*point.position, *point.velocity, Math.magnitude(point.velocity)))
 
             # pull_direction = Math.normalize(Math.tuple_minus(point.position, pull_from))
             # pull_from = point.position
 
-    def draw(self, window: ManagedWindow):
-        for i, point in enumerate(self.points):
-            # pygame.draw.circle(window.surface, Color.WHITE, point.position, radius=3)
+        self.index_budget.end_step()
+
+    def draw_debug(self, point: VineNode, new_position: Vec2):
+        position = point.position
+        DebugDraw.dot(self.pull_to, Color.YELLOW)
+        DebugDraw.line(position, (position.x + self.gravity[0], position.y + self.gravity[1]), Color.RED)
+        DebugDraw.line(position, (position.x + self.lift_delta.x, position.y + self.lift_delta.y), Color.GREEN)
+        DebugDraw.line(position, self.pull_to, Color.BLUE)
+        DebugDraw.line(new_position, (new_position.x + point.velocity.x, new_position.y + point.velocity.y), Color.YELLOW)
+        DebugDraw.line(position, new_position, Color.PINK)
+        DebugDraw.line(position, (position.x + self.acceleration.x, position.y + self.acceleration.y), Color.ORANGE)
+
+    def get_state(self) -> Optional[Dict[str, np.ndarray]]:
+        return {
+            "positions": np.array([point.position.as_tuple() for point in self.points], dtype=float),
+            "velocities": np.array([point.velocity.as_tuple() for point in self.points], dtype=float),
+            "magnitudes": np.array([point.magnitude for point in self.points], dtype=float),
+        }
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        for point, position, velocity, magnitude in zip(
+                self.points, state["positions"].tolist(), state["velocities"].tolist(), state["magnitudes"].tolist()):
+            point.position.set(*position)
+            point.velocity.set(*velocity)
+            point.magnitude = magnitude
+
+        self.index_budget.invalidate()
 
-            if i != 0:
-                pygame.draw.line(window.surface, Color.WHITE, self.points[i - 1].position, point.position)
-        
-        # for gizmos in self.gizmos:
-        #     if gizmos.type == Gizmos.Line:
-        #         pygame.draw.line(window.surface, gizmos.color, gizmos.argument[0], gizmos.argument[1])
-        #     elif gizmos.type == Gizmos.Dot:
-        #         pygame.draw.circle(window.surface, gizmos.color, gizmos.argument, radius=3)
+    def draw(self, window: ManagedWindow):
+        # One call for the whole chain instead of one per segment
+        if len(self.points) >= 2:
+            pygame.draw.lines(window.surface, Color.WHITE, False, [point.position for point in self.points])
 
     def save_records(self):
         with open("result.csv", "w") as f:
@@ -143,11 +194,179 @@ class Vine(Entity):
             writer.writerows(self.records)
 
 
+class VineField(Entity):
+    independent = True
+
+    EPSILON = 1e-9
+
+    def __init__(self, node_count=10, gravity=(0, 10), parent_node_delta=False, capacity=16,
+                 spatial_index: UniformGrid=None):
+        self.node_count = node_count
+        self.vine_count = 0
+
+        # Every vine is one row, every chain index one column
+        self._positions = np.zeros((capacity, node_count, 2))
+        self._velocities = np.zeros((capacity, node_count, 2))
+        self._magnitudes = np.zeros((capacity, node_count))
+
+        self.gravity = np.asarray(gravity, dtype=float)
+        self.parent_node_delta = parent_node_delta
+
+        # Rebuilt lazily, and only in steps that query often enough to earn the rebuild back
+        self.spatial_index = spatial_index
+        self.index_budget = RebuildBudget(UniformGrid.REBUILD_QUERIES)
+
+        self.previous_positions: np.ndarray = None
+
+        self.step_count = 0
+        self.drawn_step = None
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self._positions[:self.vine_count]
+
+    @property
+    def velocities(self) -> np.ndarray:
+        return self._velocities[:self.vine_count]
+
+    @property
+    def magnitudes(self) -> np.ndarray:
+        return self._magnitudes[:self.vine_count]
+
+    def add_vines(self, start_positions, node_delta=(0, 25)) -> np.ndarray:
+        start_positions = np.asarray(start_positions, dtype=float).reshape(-1, 2)
+        node_delta = np.asarray(node_delta, dtype=float)
+        start = self.vine_count
+        end = start + len(start_positions)
+
+        self._positions = Math.grow_array(self._positions, end)
+        self._velocities = Math.grow_array(self._velocities, end)
+        self._magnitudes = Math.grow_array(self._magnitudes, end)
+
+        chain_index = np.arange(self.node_count)[None, :, None]
+        self._positions[start:end] = start_positions[:, None, :] + chain_index * node_delta
+        self._velocities[start:end] = 0
+        self._magnitudes[start:end] = np.hypot(*node_delta)
+        self._magnitudes[start:end, 0] = 0
+        self.vine_count = end
+        self.index_budget.invalidate()
+
+        return np.arange(start, end)
+
+    def add_vine(self, start_position, node_delta=(0, 25)) -> int:
+        return int(self.add_vines([start_position], node_delta)[0])
+
+    def apply_force(self, force_center, force_radius, force_strength):
+        if self.spatial_index is None or not self.index_budget.use_index():
+            delta = self.positions - force_center
+            inside = np.einsum("vni,vni->vn", delta, delta) <= force_radius * force_radius
+            self.velocities[inside] += force_strength
+            return
+
+        if self.index_budget.dirty:
+            self.spatial_index.rebuild(self.positions.reshape(-1, 2))
+            self.index_budget.rebuilt()
+
+        nearby = self.spatial_index.query_radius(force_center, force_radius)
+        self.velocities.reshape(-1, 2)[nearby] += force_strength
+
+    def update(self, delta_time: float):
+        if self.vine_count == 0:
+            return
+
+        delta_time *= 2
+
+        positions = self.positions
+        velocities = self.velocities
+        magnitudes = self.magnitudes
+        offset = np.zeros((self.vine_count, 2))
+
+        pull_direction = np.zeros((self.vine_count, 2))
+        pull_direction[:, 1] = 1
+
+        for i in range(1, self.node_count):
+            point = positions[:, i]
+            if self.parent_node_delta:
+                # Same as shifting every later node by each parent's delta, but done once per node
+                point += offset
+
+            pull_from = positions[:, i - 1]
+            if i >= 2:
+                pull_direction = positions[:, i - 2] - pull_from
+                pull_direction /= np.maximum(np.hypot(pull_direction[:, 0], pull_direction[:, 1]), self.EPSILON)[:, None]
+
+            magnitude = magnitudes[:, i, None]
+            pull_to = pull_direction * magnitude + pull_from
+
+            acceleration = self.gravity + (pull_from - point) * 0.3 + (pull_to - point)
+
+            velocity = velocities[:, i]
+            velocity += acceleration * delta_time
+
+            suppose_point = point + velocity * delta_time
+            suppose_delta = suppose_point - pull_from
+            suppose_distance = np.maximum(np.hypot(suppose_delta[:, 0], suppose_delta[:, 1]), self.EPSILON)
+            new_position = pull_from + suppose_delta * (magnitude / suppose_distance[:, None])
+
+            velocity += new_position - suppose_point
+
+            if self.parent_node_delta:
+                offset += new_position - point
+            point[:] = new_position
+
+        self.index_budget.end_step()
+        self.step_count += 1
+
+        if DebugDraw.enabled(VINE_DEBUG_CHANNEL):
+            positions = self.positions.reshape(-1, 2)
+            DebugDraw.lines(positions, positions + self.velocities.reshape(-1, 2), Color.YELLOW)
+
+    def store_state(self):
+        self.previous_positions = self.positions.copy()
+
+    def get_state(self) -> Optional[Dict[str, np.ndarray]]:
+        return {
+            "positions": self.positions,
+            "velocities": self.velocities,
+            "magnitudes": self.magnitudes,
+            "step_count": np.array(self.step_count),
+        }
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        vine_count = len(state["positions"])
+        self._positions = Math.grow_array(self._positions, vine_count)
+        self._velocities = Math.grow_array(self._velocities, vine_count)
+        self._magnitudes = Math.grow_array(self._magnitudes, vine_count)
+        self.vine_count = vine_count
+
+        self.positions[:] = state["positions"]
+        self.velocities[:] = state["velocities"]
+        self.magnitudes[:] = state["magnitudes"]
+        self.step_count = int(state["step_count"])
+
+        self.index_budget.invalidate()
+        self.previous_positions = None
+        self.drawn_step = None
+
+    def is_dirty(self) -> bool:
+        return self.step_count != self.drawn_step or self.previous_positions is not None
+
+    def bounding_rect(self) -> Optional[pygame.Rect]:
+        if self.vine_count == 0:
+            return None
+        return Math.bounding_rect(self.positions, 1)
+
+    def draw(self, window: ManagedWindow):
+        self.drawn_step = self.step_count
+        draw_polylines(window.surface, window.interpolate_array(self.previous_positions, self.positions), Color.WHITE)
+
+
 class FakeCollider(ClickablePoint):
     def __init__(self, position, **kwargs):
         super().__init__(position, **kwargs)
 
         self.vines: List[Vine] = []
+        self.vine_fields: List[VineField] = []
 
     def update(self, delta_time: float):
         super().update(delta_time)
@@ -159,12 +378,16 @@ class FakeCollider(ClickablePoint):
             for vine in self.vines:
                 vine.apply_force(self.position, self.radius, delta)
 
+            for vine_field in self.vine_fields:
+                vine_field.apply_force(self.position, self.radius, delta)
+
     def draw(self, window: "ManagedWindow"):
         super().draw(window)
 
 
 if __name__ == "__main__":
-    window = ManagedWindow((300, 300), step_update=False, tick=30)
+    headless = "--headless" in sys.argv
+    window = ManagedWindow((300, 300), step_update=False, tick=30, headless=headless)
     # vine = Vine((150, 10), node_delta=(6, 8), length=20, gravity=(0, 30))
     # vine.update(0)
     # window.children.append(Vine((150, 10), node_delta=(6, 8), length=20, gravity=(0, 30)))
@@ -186,13 +409,29 @@ if __name__ == "__main__":
     # window.children.append(vine)
     # collider.vines.append(vine)
 
-    for x in range(100, 210, 10):
-        vine = Vine((x, 10), node_delta=(0, 10), length=20, gravity=(0, 30))
-        window.children.append(vine)
-        collider.vines.append(vine)
+    # for x in range(100, 210, 10):
+    #     vine = Vine((x, 10), node_delta=(0, 10), length=20, gravity=(0, 30))
+    #     window.children.append(vine)
+    #     collider.vines.append(vine)
+
+    vine_field = VineField(node_count=20, gravity=(0, 30), spatial_index=UniformGrid(cell_size=15))
+    vine_field.add_vines([(x, 10) for x in range(100, 210, 10)], node_delta=(0, 10))
+    window.children.append(vine_field)
+    collider.vine_fields.append(vine_field)
 
     window.children.append(collider)
 
-    window.run()
+    if "--record" in sys.argv:
+        # Keeps the last frames in memory and streams them to recording/session_* for window.seek / replay
+        window.enable_recorder(path="recording")
+
+    if headless:
+        # Sweep the collider through the vines and back
+        timeline = InputTimeline()
+        timeline.drag(30, 90, (50, 100), (250, 100))
+        timeline.drag(120, 180, (250, 100), (50, 100))
+        window.run_headless(steps=1000, timeline=timeline)
+    else:
+        window.run()
 
     # vine.save_records()